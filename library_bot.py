@@ -1,20 +1,37 @@
 import logging
 import asyncio
+import csv
+import heapq
 import os
-from datetime import datetime, timedelta
-from typing import Optional, List
+import re
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import cache, lru_cache
+from itertools import groupby
+from operator import itemgetter
+from datetime import datetime, timedelta, time
+from time import monotonic
+from typing import Optional, List, Tuple, Dict, Any, Callable, Awaitable, Deque
 
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import (
-    Message, CallbackQuery, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
+    Message, CallbackQuery, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat,
+    BufferedInputFile
 )
 from aiogram.filters import CommandStart, Command, StateFilter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.methods import SendMessage, CopyMessage, SendPhoto, SendDocument
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.exceptions import TelegramBadRequest
 import asyncpg
+import orjson
+from asyncpg.connection import Connection
 from asyncpg.pool import Pool
 from dotenv import load_dotenv
 
@@ -26,30 +43,234 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-GROUP_CHAT_ID = int(os.getenv("GROUP_CHAT_ID", "-5126633040"))
-DATABASE_URL = os.getenv("DATABASE_URL")
+# ------------------------------ Конфигурация ------------------------------
+@dataclass(frozen=True, slots=True)
+class Config:
+    bot_token: str
+    group_chat_id: int
+    database_url: str
+    db_pool_min: int
+    db_pool_max: int
+    db_pool_idle: float
+    db_statement_cache: int
+    db_command_timeout: float
+    admin_ids: frozenset
+    user_cache_ttl: float
+
+def load_config() -> Config:
+    """Читает и проверяет переменные окружения один раз при старте"""
+    bot_token = os.getenv("BOT_TOKEN")
+    database_url = os.getenv("DATABASE_URL")
+    if not bot_token:
+        logger.error("BOT_TOKEN не найден в переменных окружения!")
+        exit(1)
+    if not database_url:
+        logger.error("DATABASE_URL не найден в переменных окружения!")
+        exit(1)
+    return Config(
+        bot_token=bot_token,
+        group_chat_id=int(os.getenv("GROUP_CHAT_ID", "-5126633040")),
+        database_url=database_url,
+        db_pool_min=int(os.getenv("DB_POOL_MIN", "4")),
+        # По умолчанию — от числа ядер, но не больше 50 соединений к Postgres
+        db_pool_max=int(os.getenv("DB_POOL_MAX", str(min(50, max(20, (os.cpu_count() or 1) * 8))))),
+        db_pool_idle=float(os.getenv("DB_POOL_IDLE", "300")),
+        # asyncpg кэширует подготовленные запросы по тексту; запас, чтобы кэш не вытеснялся
+        db_statement_cache=int(os.getenv("DB_STATEMENT_CACHE", "1024")),
+        db_command_timeout=float(os.getenv("DB_COMMAND_TIMEOUT", "60")),
+        # Кто может делать рассылку (id через запятую); пусто — рассылка отключена
+        admin_ids=frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x),
+        # Кэш пользователей сбрасывается при каждой записи бота; TTL страхует от правок в обход бота
+        user_cache_ttl=float(os.getenv("USER_CACHE_TTL", "300"))
+    )
+
+CFG = load_config()
+
+# ------------------------------ Хранилище FSM ------------------------------
+@dataclass(slots=True)
+class FSMRecord:
+    data: Dict[str, Any]
+    state: Optional[str] = None
 
-if not BOT_TOKEN:
-    logger.error("BOT_TOKEN не найден в переменных окружения!")
-    exit(1)
-if not DATABASE_URL:
-    logger.error("DATABASE_URL не найден в переменных окружения!")
-    exit(1)
+class FastMemoryStorage(BaseStorage):
+    """In-memory хранилище FSM: запись создаётся только при записи и удаляется после state.clear()"""
+
+    def __init__(self):
+        self.storage: Dict[StorageKey, FSMRecord] = {}
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+    def _record(self, key: StorageKey) -> FSMRecord:
+        record = self.storage.get(key)
+        if record is None:
+            record = self.storage[key] = FSMRecord({})
+        return record
+
+    def _drop_if_empty(self, key: StorageKey, record: FSMRecord):
+        if record.state is None and not record.data:
+            del self.storage[key]
+
+    async def close(self):
+        pass
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        record = self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._drop_if_empty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self.storage.get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]):
+        record = self._record(key)
+        record.data = data.copy()
+        self._drop_if_empty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self.storage.get(key)
+        return record.data.copy() if record else {}
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        # Обновляем на месте: одна копия на выходе вместо трёх в BaseStorage.update_data
+        record = self._record(key)
+        record.data.update(data)
+        self._drop_if_empty(key, record)
+        return record.data.copy()
+
+# orjson вместо stdlib json для клавиатур и ответов Bot API
+session = AiohttpSession(
+    json_loads=orjson.loads,
+    json_dumps=lambda value: orjson.dumps(value).decode()
+)
+bot = Bot(token=CFG.bot_token, session=session)
+storage = FastMemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
 
 RULES_URL = "https://docs.google.com/document/d/1l9nUMiQPCYPPoV_deUjroP2BZb6MRRRBVtw_D57NAxs/edit?usp=sharing"
 
-# ------------------------------ Глобальные переменные для админ-режимов ------------------------------
-group_awaiting_action = None
-group_awaiting_author = None
+# Срок брони -> длительность
+BOOKING_DURATIONS = {
+    "1 час": timedelta(hours=1),
+    "1 неделя": timedelta(weeks=1),
+    "1 месяц": timedelta(days=30),
+    "3 месяца": timedelta(days=90),
+    "6 месяцев": timedelta(days=180),
+}
+# Срок брони -> (на сколько продлевается, как это написать пользователю)
+BOOKING_EXTENSIONS = {
+    "1 час": (timedelta(minutes=15), "15 минут"),
+    "1 неделя": (timedelta(weeks=1), "1 неделю"),
+    "1 месяц": (timedelta(days=14), "2 недели"),
+    "3 месяца": (timedelta(days=30), "1 месяц"),
+    "6 месяцев": (timedelta(days=60), "2 месяца"),
+}
+# Те же продления в виде массивов для UPDATE ... FROM unnest(...)
+EXTENSION_DURATIONS = list(BOOKING_EXTENSIONS)
+EXTENSION_INTERVALS = [extension for extension, _ in BOOKING_EXTENSIONS.values()]
+# callback_data кнопок -> значения, которые они выбирают
+OFFICE_CALLBACKS = {
+    "office_stone": "Stone Towers",
+    "office_manhatten": "Manhatten",
+    "office_izvestia": "Известия",
+}
+DURATION_CALLBACKS = {
+    "duration_1h": "1 час",
+    "duration_1w": "1 неделя",
+    "duration_1m": "1 месяц",
+    "duration_3m": "3 месяца",
+    "duration_6m": "6 месяцев",
+}
 
 # ------------------------------ База данных ------------------------------
+# SQL самых частых запросов в одном месте; их подготовку на каждом соединении кэширует asyncpg (statement_cache_size)
+HOT_SQL: Dict[str, str] = {
+    "user_info": 'SELECT first_name, last_name, office, status, rules_accepted FROM users WHERE user_id = $1',
+    "user_context": '''
+        SELECT u.first_name, u.last_name, u.office, u.status, u.rules_accepted,
+               b.id as booking_id, b.book_id, b.book_title,
+               b.start_time as booking_start,
+               b.duration as booking_duration,
+               b.end_time as booking_end
+        FROM users u
+        LEFT JOIN bookings b ON b.user_id = u.user_id AND b.status = 'active' AND u.status = 'booked'
+        WHERE u.user_id = $1
+        LIMIT 1
+    ''',
+    "books_by_office": '''
+        SELECT id, title, author, shelf, floor FROM books
+        WHERE office = $1 AND status = 'available' ORDER BY title, id
+    ''',
+    "available_book": '''
+        SELECT id, title, author, shelf, floor
+        FROM books
+        WHERE title_norm = LOWER($1) AND office = $2 AND status = 'available'
+        LIMIT 1
+    ''',
+    "available_copy_of": '''
+        SELECT a.id, a.title, a.author, a.office, a.shelf, a.floor
+        FROM books b
+        JOIN books a ON a.title_norm = b.title_norm AND a.office = b.office AND a.status = 'available'
+        WHERE b.id = $1
+        LIMIT 1
+    ''',
+    "book_any_status": '''
+        SELECT id, title, author, shelf, floor, status
+        FROM books
+        WHERE title_norm = LOWER($1) AND office = $2
+        LIMIT 1
+    ''',
+    "existing_users": 'SELECT user_id FROM users WHERE user_id = ANY($1::bigint[])',
+    # Книга, лист ожидания, бронь и пользователь — одним запросом (и одной транзакцией)
+    "create_booking": '''
+        WITH upd_book AS (
+            UPDATE books SET status = 'booked' WHERE id = $2
+        ),
+        del_wl AS (
+            DELETE FROM waiting_list WHERE user_id = $1 AND book_title = $3 AND office = $4
+        ),
+        upd_user AS (
+            UPDATE users
+            SET current_book = $3, booking_start = $5, booking_duration = $6, booking_end = $7, status = 'booked'
+            WHERE user_id = $1
+        ),
+        ins AS (
+            INSERT INTO bookings
+                (user_id, book_id, book_title, office, start_time, duration, end_time, extension_made, overdue_notified)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, FALSE, FALSE)
+            RETURNING id
+        )
+        SELECT id FROM ins
+    ''',
+    "complete_booking": '''
+        WITH upd_book AS (
+            UPDATE books SET status = 'available' WHERE id = $2
+        ),
+        upd_booking AS (
+            UPDATE bookings SET status = 'completed' WHERE id = $3
+        )
+        UPDATE users
+        SET current_book = NULL, booking_start = NULL, booking_duration = NULL, booking_end = NULL, status = 'available'
+        WHERE user_id = $1
+    ''',
+    # Отметку о просрочке ставит сама БД: сообщение уходит, только если её ещё не было
+    "claim_overdue": '''
+        UPDATE bookings SET overdue_notified = TRUE
+        WHERE id = $1 AND status = 'active' AND NOT overdue_notified AND end_time + $2 <= $3
+        RETURNING id
+    ''',
+    "due_bookings": '''
+        SELECT b.id as booking_id, u.user_id, u.first_name, u.last_name,
+               b.book_title, b.start_time as booking_start,
+               b.duration as booking_duration, b.end_time as booking_end,
+               b.extension_made, b.overdue_notified
+        FROM bookings b
+        JOIN users u ON u.user_id = b.user_id
+        WHERE b.id = ANY($1::int[]) AND b.status = 'active' AND u.status = 'booked'
+    ''',
+}
+
+
 class Database:
     def __init__(self):
         self.pool: Optional[Pool] = None
@@ -57,16 +278,28 @@ class Database:
     async def create_pool(self):
         try:
             self.pool = await asyncpg.create_pool(
-                DATABASE_URL,
-                min_size=1,
-                max_size=10,
-                command_timeout=60
+                CFG.database_url,
+                min_size=CFG.db_pool_min,
+                max_size=CFG.db_pool_max,
+                # простаивающие соединения закрываются, но тёплый минимум остаётся
+                max_inactive_connection_lifetime=CFG.db_pool_idle,
+                statement_cache_size=CFG.db_statement_cache,
+                command_timeout=CFG.db_command_timeout
             )
             logger.info("Пул соединений с БД создан")
         except Exception as e:
             logger.error(f"Ошибка создания пула: {e}")
             raise
 
+    @asynccontextmanager
+    async def connection(self, conn: Optional[Connection] = None):
+        """Отдаёт переданное соединение или берёт новое из пула"""
+        if conn is not None:
+            yield conn
+        else:
+            async with self.pool.acquire() as conn:
+                yield conn
+
     async def close(self):
         if self.pool:
             await self.pool.close()
@@ -88,86 +321,85 @@ class UserStates(StatesGroup):
     waiting_for_waitlist_choice = State()
     waiting_for_book_request = State()
 
+# Режимы редактирования в группе: состояние хранится отдельно для каждого админа
+class AdminStates(StatesGroup):
+    editing_books = State()
+    editing_users = State()
+
 # ------------------------------ Инициализация БД ------------------------------
+# Вся схема одним пакетом: без параметров asyncpg выполняет его за один запрос к серверу
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        first_name TEXT NOT NULL,
+        last_name TEXT,
+        office TEXT,
+        current_book TEXT,
+        booking_start TIMESTAMP,
+        booking_duration TEXT,
+        booking_end TIMESTAMP,
+        status TEXT DEFAULT 'available',
+        rules_accepted BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS rules_accepted BOOLEAN DEFAULT FALSE;
+
+    CREATE TABLE IF NOT EXISTS books (
+        id SERIAL PRIMARY KEY,
+        title TEXT NOT NULL,
+        author TEXT NOT NULL,
+        office TEXT NOT NULL,
+        status TEXT DEFAULT 'available',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE books ADD COLUMN IF NOT EXISTS shelf INTEGER;
+    ALTER TABLE books ADD COLUMN IF NOT EXISTS floor INTEGER;
+    -- Название в нижнем регистре для поиска без LOWER() по каждой строке
+    ALTER TABLE books ADD COLUMN IF NOT EXISTS title_norm TEXT GENERATED ALWAYS AS (LOWER(title)) STORED;
+
+    CREATE TABLE IF NOT EXISTS bookings (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT REFERENCES users(user_id),
+        book_id INTEGER REFERENCES books(id),
+        book_title TEXT NOT NULL,
+        office TEXT NOT NULL,
+        start_time TIMESTAMP NOT NULL,
+        duration TEXT NOT NULL,
+        end_time TIMESTAMP NOT NULL,
+        status TEXT DEFAULT 'active',
+        extension_made BOOLEAN DEFAULT FALSE,
+        overdue_notified BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE bookings ADD COLUMN IF NOT EXISTS book_id INTEGER REFERENCES books(id);
+    ALTER TABLE bookings ADD COLUMN IF NOT EXISTS extension_made BOOLEAN DEFAULT FALSE;
+    ALTER TABLE bookings ADD COLUMN IF NOT EXISTS overdue_notified BOOLEAN DEFAULT FALSE;
+
+    CREATE TABLE IF NOT EXISTS waiting_list (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT REFERENCES users(user_id),
+        book_title TEXT NOT NULL,
+        office TEXT NOT NULL,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        notified BOOLEAN DEFAULT FALSE,
+        CONSTRAINT unique_waiting_entry UNIQUE (user_id, book_title, office)
+    );
+
+    -- Индексы под частые выборки: каталог офиса, поиск по названию, активные брони, лист ожидания
+    CREATE INDEX IF NOT EXISTS idx_books_office_status ON books(office, status);
+    CREATE INDEX IF NOT EXISTS idx_books_titlenorm_office ON books(title_norm, office);
+    -- Покрывающий индекс: счётчики статистики по пользователю читаются без обращения к таблице
+    CREATE INDEX IF NOT EXISTS idx_bookings_user_status_stats
+        ON bookings(user_id, status) INCLUDE (extension_made, overdue_notified);
+    CREATE INDEX IF NOT EXISTS idx_bookings_active_end ON bookings(end_time) WHERE status = 'active';
+    CREATE INDEX IF NOT EXISTS idx_waitlist_book_office_notnotified
+        ON waiting_list(book_title, office, added_at) WHERE NOT notified;
+'''
+
 async def init_db():
     async with db.pool.acquire() as conn:
-        # Таблица пользователей
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                first_name TEXT NOT NULL,
-                last_name TEXT,
-                office TEXT,
-                current_book TEXT,
-                booking_start TIMESTAMP,
-                booking_duration TEXT,
-                booking_end TIMESTAMP,
-                status TEXT DEFAULT 'available',
-                rules_accepted BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        try:
-            await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS rules_accepted BOOLEAN DEFAULT FALSE;')
-            logger.info("Колонка rules_accepted добавлена/существует")
-        except Exception as e:
-            logger.error(f"Ошибка добавления rules_accepted: {e}")
-
-        # Таблица книг
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS books (
-                id SERIAL PRIMARY KEY,
-                title TEXT NOT NULL,
-                author TEXT NOT NULL,
-                office TEXT NOT NULL,
-                status TEXT DEFAULT 'available',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        try:
-            await conn.execute('ALTER TABLE books ADD COLUMN IF NOT EXISTS shelf INTEGER;')
-            await conn.execute('ALTER TABLE books ADD COLUMN IF NOT EXISTS floor INTEGER;')
-            logger.info("Колонки shelf/floor добавлены/существуют")
-        except Exception as e:
-            logger.error(f"Ошибка добавления shelf/floor: {e}")
-
-        # Таблица бронирований
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS bookings (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                book_id INTEGER REFERENCES books(id),
-                book_title TEXT NOT NULL,
-                office TEXT NOT NULL,
-                start_time TIMESTAMP NOT NULL,
-                duration TEXT NOT NULL,
-                end_time TIMESTAMP NOT NULL,
-                status TEXT DEFAULT 'active',
-                extension_made BOOLEAN DEFAULT FALSE,
-                overdue_notified BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        try:
-            await conn.execute('ALTER TABLE bookings ADD COLUMN IF NOT EXISTS book_id INTEGER REFERENCES books(id);')
-            await conn.execute('ALTER TABLE bookings ADD COLUMN IF NOT EXISTS extension_made BOOLEAN DEFAULT FALSE;')
-            await conn.execute('ALTER TABLE bookings ADD COLUMN IF NOT EXISTS overdue_notified BOOLEAN DEFAULT FALSE;')
-            logger.info("Колонки book_id, extension_made, overdue_notified добавлены/существуют")
-        except Exception as e:
-            logger.error(f"Ошибка добавления колонок в bookings: {e}")
-
-        # Таблица листа ожидания
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS waiting_list (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                book_title TEXT NOT NULL,
-                office TEXT NOT NULL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                notified BOOLEAN DEFAULT FALSE,
-                CONSTRAINT unique_waiting_entry UNIQUE (user_id, book_title, office)
-            )
-        ''')
+        await conn.execute(SCHEMA_SQL)
+        logger.info("Таблицы и колонки созданы/существуют")
 
         # Проверка наличия начальных книг
         count = await conn.fetchval('SELECT COUNT(*) FROM books')
@@ -182,23 +414,63 @@ async def init_db():
                 ("книга z", "автор Z", "Известия", None, None),
                 ("книга y", "автор У", "Известия", None, None)
             ]
-            for title, author, office, shelf, floor in books_data:
-                await conn.execute(
-                    'INSERT INTO books (title, author, office, shelf, floor) VALUES ($1, $2, $3, $4, $5)',
-                    title, author, office, shelf, floor
-                )
+            await conn.copy_records_to_table(
+                'books',
+                records=books_data,
+                columns=('title', 'author', 'office', 'shelf', 'floor')
+            )
             logger.info("Начальные книги добавлены")
         else:
             # Обновление полок/этажей для Stone Towers
             stone_books = [("книга а", 1, 5), ("книга в", 4, 5), ("книга с", 3, 6)]
-            for title, shelf, floor in stone_books:
-                await conn.execute(
-                    'UPDATE books SET shelf = $1, floor = $2 WHERE LOWER(title) = LOWER($3) AND office = $4',
-                    shelf, floor, title, 'Stone Towers'
-                )
+            await conn.executemany(
+                'UPDATE books SET shelf = $2, floor = $3 WHERE title_norm = LOWER($1) AND office = $4',
+                [(title, shelf, floor, 'Stone Towers') for title, shelf, floor in stone_books]
+            )
             logger.info("Обновлены полки/этажи для Stone Towers")
         logger.info("Инициализация БД завершена")
 
+# ------------------------------ Кэш пользователей ------------------------------
+# user_id -> (момент чтения, строка из БД или None). Сбрасывается при любой записи в users/bookings.
+USER_CACHE_SIZE = 4096
+_user_info_cache: Dict[int, Tuple[float, Optional[asyncpg.Record]]] = {}
+_user_context_cache: Dict[int, Tuple[float, Optional[asyncpg.Record]]] = {}
+# user_id -> номер сброса кэша. Чтение, начатое до сброса, не кладёт в кэш устаревшую строку.
+_user_cache_version: Dict[int, int] = {}
+
+def _cache_get(cache: dict, user_id: int):
+    entry = cache.get(user_id)
+    if entry is None:
+        return False, None
+    if monotonic() - entry[0] < CFG.user_cache_ttl:
+        return True, entry[1]
+    del cache[user_id]
+    return False, None
+
+def _cache_put(cache: dict, user_id: int, row: Optional[asyncpg.Record], version: int):
+    if _user_cache_version.get(user_id, 0) != version:
+        return
+    # Порядок вставки = порядок чтения: при переполнении вытесняется самая старая запись
+    cache.pop(user_id, None)
+    cache[user_id] = (monotonic(), row)
+    if len(cache) > USER_CACHE_SIZE:
+        del cache[next(iter(cache))]
+
+def invalidate_user_cache(user_id: int):
+    _user_cache_version[user_id] = _user_cache_version.get(user_id, 0) + 1
+    _user_info_cache.pop(user_id, None)
+    _user_context_cache.pop(user_id, None)
+
+# Список id для рассылки: (момент чтения, id). Сбрасывается при регистрации и удалении пользователей.
+USER_IDS_TTL = 60
+_user_ids_cache: Optional[Tuple[float, List[int]]] = None
+_user_ids_version = 0
+
+def invalidate_user_ids():
+    global _user_ids_cache, _user_ids_version
+    _user_ids_cache = None
+    _user_ids_version += 1
+
 # ------------------------------ Функции работы с БД ------------------------------
 async def register_user(user_id: int, first_name: str, last_name: str):
     async with db.pool.acquire() as conn:
@@ -210,187 +482,132 @@ async def register_user(user_id: int, first_name: str, last_name: str):
             ''',
             user_id, first_name, last_name
         )
+    invalidate_user_cache(user_id)
+    invalidate_user_ids()
+
+async def get_all_user_ids() -> List[int]:
+    global _user_ids_cache
+    if _user_ids_cache is not None and monotonic() - _user_ids_cache[0] < USER_IDS_TTL:
+        return _user_ids_cache[1]
+    version = _user_ids_version
+    rows = await db.pool.fetch('SELECT user_id FROM users')
+    user_ids = [r['user_id'] for r in rows]
+    if version == _user_ids_version:
+        _user_ids_cache = (monotonic(), user_ids)
+    return user_ids
 
 async def accept_rules(user_id: int):
     async with db.pool.acquire() as conn:
         await conn.execute('UPDATE users SET rules_accepted = TRUE WHERE user_id = $1', user_id)
+    invalidate_user_cache(user_id)
 
 async def update_user_office(user_id: int, office: str):
     async with db.pool.acquire() as conn:
         await conn.execute('UPDATE users SET office = $1 WHERE user_id = $2', office, user_id)
-
-async def get_user_info(user_id: int):
-    async with db.pool.acquire() as conn:
-        return await conn.fetchrow(
-            'SELECT first_name, last_name, office, status, rules_accepted FROM users WHERE user_id = $1',
-            user_id
-        )
+    invalidate_user_cache(user_id)
+
+async def get_user_info(user_id: int, conn: Optional[Connection] = None):
+    hit, row = _cache_get(_user_info_cache, user_id)
+    if hit:
+        return row
+    version = _user_cache_version.get(user_id, 0)
+    async with db.connection(conn) as conn:
+        row = await conn.fetchrow(HOT_SQL["user_info"], user_id)
+    _cache_put(_user_info_cache, user_id, row, version)
+    return row
 
 async def get_books_by_office(office: str):
     """Возвращает ВСЕ доступные экземпляры книг в офисе"""
     async with db.pool.acquire() as conn:
-        return await conn.fetch(
-            'SELECT id, title, author, shelf, floor FROM books WHERE office = $1 AND status = $2 ORDER BY title, id',
-            office, 'available'
-        )
+        return await conn.fetch(HOT_SQL["books_by_office"], office)
+
+async def get_available_copy_of(book_id: int, conn: Optional[Connection] = None):
+    """Доступный экземпляр той же книги (название и офис), что и экземпляр book_id"""
+    async with db.connection(conn) as conn:
+        return await conn.fetchrow(HOT_SQL["available_copy_of"], book_id)
 
-async def get_book_by_title_any_status(title: str, office: str):
+async def get_book_by_title_any_status(title: str, office: str, conn: Optional[Connection] = None):
     """Проверяет, существует ли книга в офисе (любой статус). Возвращает первую запись."""
-    async with db.pool.acquire() as conn:
-        return await conn.fetchrow(
-            '''
-            SELECT id, title, author, shelf, floor, status
-            FROM books 
-            WHERE LOWER(title) = LOWER($1) AND office = $2
-            LIMIT 1
-            ''',
-            title, office
-        )
+    async with db.connection(conn) as conn:
+        return await conn.fetchrow(HOT_SQL["book_any_status"], title, office)
 
-async def get_available_book_instance(title: str, office: str):
+async def get_available_book_instance(title: str, office: str, conn: Optional[Connection] = None):
     """Возвращает ОДИН доступный экземпляр книги в офисе (status = 'available')."""
-    async with db.pool.acquire() as conn:
-        return await conn.fetchrow(
-            '''
-            SELECT id, title, author, shelf, floor
-            FROM books 
-            WHERE LOWER(title) = LOWER($1) AND office = $2 AND status = 'available'
-            LIMIT 1
-            ''',
-            title, office
-        )
-
-async def update_book_status(book_id: int, status: str):
-    """Обновляет статус конкретного экземпляра книги по его ID"""
-    async with db.pool.acquire() as conn:
-        await conn.execute(
-            'UPDATE books SET status = $1 WHERE id = $2',
-            status, book_id
-        )
-
-async def get_user_booking(user_id: int):
-    """Возвращает активное бронирование пользователя с ID брони и ID книги"""
-    async with db.pool.acquire() as conn:
-        return await conn.fetchrow(
-            '''
-            SELECT b.id as booking_id, b.book_id, b.book_title, 
-                   b.start_time as booking_start, 
-                   b.duration as booking_duration, 
-                   b.end_time as booking_end
-            FROM users u
-            JOIN bookings b ON u.user_id = b.user_id AND b.status = 'active'
-            WHERE u.user_id = $1 AND u.status = 'booked'
-            LIMIT 1
-            ''',
-            user_id
-        )
+    async with db.connection(conn) as conn:
+        return await conn.fetchrow(HOT_SQL["available_book"], title, office)
+
+async def get_user_context(user_id: int, conn: Optional[Connection] = None):
+    """Пользователь и его активная бронь одним запросом (booking_id = None, если брони нет)"""
+    hit, row = _cache_get(_user_context_cache, user_id)
+    if hit:
+        return row
+    version = _user_cache_version.get(user_id, 0)
+    async with db.connection(conn) as conn:
+        row = await conn.fetchrow(HOT_SQL["user_context"], user_id)
+    _cache_put(_user_context_cache, user_id, row, version)
+    return row
 
 async def create_booking(user_id: int, book_id: int, book_title: str, office: str, duration: str):
     """Создаёт бронь для конкретного экземпляра книги"""
     async with db.pool.acquire() as conn:
         start_time = datetime.now()
-        if duration == "1 час":
-            end_time = start_time + timedelta(hours=1)
-        elif duration == "1 неделя":
-            end_time = start_time + timedelta(weeks=1)
-        elif duration == "1 месяц":
-            end_time = start_time + timedelta(days=30)
-        elif duration == "3 месяца":
-            end_time = start_time + timedelta(days=90)
-        elif duration == "6 месяцев":
-            end_time = start_time + timedelta(days=180)
-        else:
+        if duration not in BOOKING_DURATIONS:
             raise ValueError(f"Неизвестная длительность: {duration}")
+        end_time = start_time + BOOKING_DURATIONS[duration]
 
-        async with conn.transaction():
-            await update_book_status(book_id, "booked")
-            await remove_from_waiting_list(user_id, book_title, office)
-
-            booking_id = await conn.fetchval(
-                '''
-                INSERT INTO bookings 
-                    (user_id, book_id, book_title, office, start_time, duration, end_time, extension_made, overdue_notified)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-                RETURNING id
-                ''',
-                user_id, book_id, book_title, office, start_time, duration, end_time, False, False
-            )
-
-            await conn.execute(
-                '''
-                UPDATE users 
-                SET current_book = $1, booking_start = $2, booking_duration = $3, booking_end = $4, status = 'booked'
-                WHERE user_id = $5
-                ''',
-                book_title, start_time, duration, end_time, user_id
-            )
+        booking_id = await conn.fetchval(HOT_SQL["create_booking"], user_id, book_id, book_title, office, start_time, duration, end_time)
+        invalidate_user_cache(user_id)
+        schedule_reminders(booking_id, start_time, end_time, duration, now=start_time)
         return booking_id, end_time
 
 async def complete_booking(user_id: int, booking_id: int, book_id: int, book_title: str, office: str):
     """Завершаем бронь и освобождаем конкретный экземпляр"""
     async with db.pool.acquire() as conn:
-        async with conn.transaction():
-            await update_book_status(book_id, "available")
-            await conn.execute(
-                '''
-                UPDATE users 
-                SET current_book = NULL, booking_start = NULL, booking_duration = NULL, booking_end = NULL, status = 'available'
-                WHERE user_id = $1
-                ''',
-                user_id
-            )
-            
-            await conn.execute(
-                'UPDATE bookings SET status = $1 WHERE id = $2',
-                'completed', booking_id
-            )
-            
-            await notify_next_in_waiting_list(book_title, office)
-
-async def extend_booking(booking_id: int, user_id: int, book_title: str, office: str):
+        await conn.fetchval(HOT_SQL["complete_booking"], user_id, book_id, booking_id)
+        waiting_user = await get_first_in_waiting_list(book_title, office, conn)
+    invalidate_user_cache(user_id)
+    cancel_reminders(booking_id)
+    # Уведомляем после фиксации и возврата соединения в пул: запрос к Telegram его не держит
+    if waiting_user:
+        await notify_waiting_user(waiting_user, book_id, book_title, office)
+
+async def extend_booking(booking_id: int, user_id: int):
+    """Продлевает активную бронь один раз. Проверка и продление — одним UPDATE, без гонки"""
     async with db.pool.acquire() as conn:
         booking = await conn.fetchrow(
-            'SELECT duration, end_time, extension_made FROM bookings WHERE id = $1 AND user_id = $2 AND status = $3',
-            booking_id, user_id, 'active'
+            '''
+            WITH ext AS (
+                UPDATE bookings b
+                SET end_time = b.end_time + e.extension, extension_made = TRUE
+                FROM unnest($3::text[], $4::interval[]) AS e(duration, extension)
+                WHERE b.id = $1 AND b.user_id = $2 AND b.status = 'active'
+                  AND NOT b.extension_made AND b.duration = e.duration
+                RETURNING b.start_time, b.duration, b.end_time, b.book_title
+            ),
+            upd_user AS (
+                UPDATE users u SET booking_end = ext.end_time
+                FROM ext
+                WHERE u.user_id = $2 AND u.current_book = ext.book_title AND u.status = 'booked'
+            )
+            SELECT ext.*, u.first_name, u.last_name
+            FROM ext JOIN users u ON u.user_id = $2
+            ''',
+            booking_id, user_id, EXTENSION_DURATIONS, EXTENSION_INTERVALS
         )
         if not booking:
-            raise ValueError("Бронирование не найдено или уже завершено")
-        if booking['extension_made']:
-            raise ValueError("Бронь уже была продлена ранее")
-
-        original_duration = booking['duration']
-        current_end = booking['end_time']
-
-        if original_duration == "1 час":
-            extension = timedelta(minutes=15)
-            extension_text = "15 минут"
-        elif original_duration == "1 неделя":
-            extension = timedelta(weeks=1)
-            extension_text = "1 неделю"
-        elif original_duration == "1 месяц":
-            extension = timedelta(days=14)
-            extension_text = "2 недели"
-        elif original_duration == "3 месяца":
-            extension = timedelta(days=30)
-            extension_text = "1 месяц"
-        elif original_duration == "6 месяцев":
-            extension = timedelta(days=60)
-            extension_text = "2 месяца"
-        else:
-            raise ValueError("Неизвестная длительность")
-
-        new_end = current_end + extension
-
-        async with conn.transaction():
-            await conn.execute(
-                'UPDATE bookings SET end_time = $1, extension_made = TRUE WHERE id = $2',
-                new_end, booking_id
-            )
-            await conn.execute(
-                'UPDATE users SET booking_end = $1 WHERE user_id = $2 AND current_book = $3 AND status = $4',
-                new_end, user_id, book_title, 'booked'
+            # Ничего не обновлено — отдельным запросом выясняем причину для пользователя
+            current = await conn.fetchrow(
+                'SELECT duration, extension_made FROM bookings WHERE id = $1 AND user_id = $2 AND status = $3',
+                booking_id, user_id, 'active'
             )
-        return new_end, extension_text
+            if not current:
+                raise ValueError("Бронирование не найдено или уже завершено")
+            if current['extension_made']:
+                raise ValueError("Вы уже продлевали это бронирование")
+            raise ValueError("Неизвестная длительность")
+    invalidate_user_cache(user_id)
+    schedule_reminders(booking_id, booking['start_time'], booking['end_time'], booking['duration'])
+    return booking, BOOKING_EXTENSIONS[booking['duration']][1]
 
 async def add_to_waiting_list(user_id: int, book_title: str, office: str):
     async with db.pool.acquire() as conn:
@@ -408,56 +625,54 @@ async def add_to_waiting_list(user_id: int, book_title: str, office: str):
             logger.error(f"Ошибка добавления в лист ожидания: {e}")
             return False
 
-async def get_first_in_waiting_list(book_title: str, office: str):
-    async with db.pool.acquire() as conn:
+async def get_first_in_waiting_list(book_title: str, office: str, conn: Optional[Connection] = None):
+    async with db.connection(conn) as conn:
         return await conn.fetchrow(
             '''
-            SELECT user_id FROM waiting_list 
-            WHERE book_title = $1 AND office = $2 AND NOT notified
-            ORDER BY added_at ASC LIMIT 1
+            SELECT w.user_id, u.first_name
+            FROM waiting_list w
+            JOIN users u ON u.user_id = w.user_id
+            WHERE w.book_title = $1 AND w.office = $2 AND NOT w.notified
+            ORDER BY w.added_at ASC LIMIT 1
             ''',
             book_title, office
         )
 
-async def remove_from_waiting_list(user_id: int, book_title: str, office: str):
-    async with db.pool.acquire() as conn:
-        await conn.execute(
-            'DELETE FROM waiting_list WHERE user_id = $1 AND book_title = $2 AND office = $3',
+async def notify_waiting_user(waiting_user: asyncpg.Record, book_id: int, book_title: str, office: str):
+    """Сообщает первому в листе ожидания, что книга освободилась"""
+    user_id = waiting_user['user_id']
+    try:
+        await bot.send_message(
+            user_id,
+            f"🎉 {waiting_user['first_name']}, книга '{book_title}' освободилась! Хотите её забронировать?",
+            reply_markup=get_waitlist_notification_keyboard(book_id)
+        )
+        await db.pool.execute(
+            'UPDATE waiting_list SET notified = TRUE WHERE user_id = $1 AND book_title = $2 AND office = $3',
             user_id, book_title, office
         )
-
-async def notify_next_in_waiting_list(book_title: str, office: str):
-    async with db.pool.acquire() as conn:
-        waiting_user = await get_first_in_waiting_list(book_title, office)
-        if waiting_user:
-            user_id = waiting_user['user_id']
-            user_info = await get_user_info(user_id)
-            if user_info:
-                first_name = user_info['first_name']
-                try:
-                    await bot.send_message(
-                        user_id,
-                        f"🎉 {first_name}, книга '{book_title}' освободилась! Хотите её забронировать?",
-                        reply_markup=get_waitlist_notification_keyboard(book_title, office)
-                    )
-                    await conn.execute(
-                        'UPDATE waiting_list SET notified = TRUE WHERE user_id = $1 AND book_title = $2 AND office = $3',
-                        user_id, book_title, office
-                    )
-                    return True
-                except Exception as e:
-                    logger.error(f"Ошибка уведомления из листа ожидания: {e}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка уведомления из листа ожидания: {e}")
         return False
 
 # ------------------------------ Управление командами меню ------------------------------
+# Последний набор команд, отправленный каждому пользователю
+_commands_cache: Dict[int, Tuple[Tuple[str, str], ...]] = {}
+
 async def set_user_commands(user_id: int, commands: List[BotCommand]):
+    key = tuple((c.command, c.description) for c in commands)
+    if _commands_cache.get(user_id) == key:
+        return
     try:
         await bot.set_my_commands(
             commands=commands,
             scope=BotCommandScopeChat(chat_id=user_id)
         )
+        _commands_cache[user_id] = key
         logger.info(f"Команды для {user_id}: {[c.command for c in commands]}")
     except Exception as e:
+        _commands_cache.pop(user_id, None)
         logger.error(f"Ошибка установки команд для {user_id}: {e}")
 
 async def set_initial_commands_after_accept(user_id: int):
@@ -497,19 +712,26 @@ async def update_commands_on_start(user_id: int, has_active_booking: bool = Fals
         await set_initial_commands_after_accept(user_id)
 
 # ------------------------------ Клавиатуры ------------------------------
+class WaitlistCB(CallbackData, prefix="wl"):
+    """Кнопка из уведомления листа ожидания: освободившийся экземпляр книги"""
+    book_id: int
+
+# Разметка не меняется между вызовами, поэтому каждая клавиатура собирается один раз
+@cache
 def get_accept_rules_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Принимаю правила библиотеки", callback_data="accept_rules")
     return builder.as_markup()
 
+@cache
 def get_office_keyboard():
     builder = InlineKeyboardBuilder()
-    builder.button(text="Stone Towers", callback_data="office_stone")
-    builder.button(text="Manhatten", callback_data="office_manhatten")
-    builder.button(text="Известия", callback_data="office_izvestia")
+    for data, office in OFFICE_CALLBACKS.items():
+        builder.button(text=office, callback_data=data)
     builder.adjust(1)
     return builder.as_markup()
 
+@cache
 def get_action_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="Забронировать", callback_data="action_book")
@@ -517,6 +739,7 @@ def get_action_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
+@cache
 def get_confirmation_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="Да", callback_data="confirm_yes")
@@ -524,16 +747,15 @@ def get_confirmation_keyboard():
     builder.adjust(2)
     return builder.as_markup()
 
+@cache
 def get_duration_keyboard():
     builder = InlineKeyboardBuilder()
-    builder.button(text="1 час", callback_data="duration_1h")
-    builder.button(text="1 неделя", callback_data="duration_1w")
-    builder.button(text="1 месяц", callback_data="duration_1m")
-    builder.button(text="3 месяца", callback_data="duration_3m")
-    builder.button(text="6 месяцев", callback_data="duration_6m")
+    for data, duration in DURATION_CALLBACKS.items():
+        builder.button(text=duration, callback_data=data)
     builder.adjust(2)
     return builder.as_markup()
 
+@cache
 def get_return_options_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="Не бронирую", callback_data="return_cancel")
@@ -541,22 +763,26 @@ def get_return_options_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
+@lru_cache(maxsize=512)
 def get_return_book_keyboard(book_title: str):
     builder = InlineKeyboardBuilder()
     builder.button(text=f"Вернуть книгу {book_title}", callback_data=f"return_{book_title}")
     builder.adjust(1)
     return builder.as_markup()
 
+@cache
 def get_finish_booking_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Завершить бронирование", callback_data="finish_booking")
     return builder.as_markup()
 
+@cache
 def get_finish_return_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Завершить возврат", callback_data="finish_return")
     return builder.as_markup()
 
+@cache
 def get_waitlist_choice_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="Добавить в лист ожидания", callback_data="waitlist_add")
@@ -564,13 +790,36 @@ def get_waitlist_choice_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
-def get_waitlist_notification_keyboard(book_title: str, office: str):
+@lru_cache(maxsize=512)
+def get_booking_ended_keyboard(book_title: str, booking_id: int, can_extend: bool):
+    builder = InlineKeyboardBuilder()
+    builder.button(text=f"Вернуть книгу {book_title}", callback_data=f"return_{book_title}")
+    if can_extend:
+        builder.button(text="⏳ Продлить бронь", callback_data=f"extend_{booking_id}")
+    builder.adjust(1)
+    return builder.as_markup()
+
+@lru_cache(maxsize=512)
+def get_retry_keyboard(callback_data: str):
+    builder = InlineKeyboardBuilder()
+    builder.button(text="Попробовать снова", callback_data=callback_data)
+    return builder.as_markup()
+
+@cache
+def get_choose_other_keyboard():
     builder = InlineKeyboardBuilder()
-    builder.button(text="Забронировать эту книгу", callback_data=f"waitlist_book_{book_title}_{office}")
+    builder.button(text="Выбрать другую книгу", callback_data="action_book")
+    return builder.as_markup()
+
+@lru_cache(maxsize=512)
+def get_waitlist_notification_keyboard(book_id: int):
+    builder = InlineKeyboardBuilder()
+    builder.button(text="Забронировать эту книгу", callback_data=WaitlistCB(book_id=book_id))
     builder.button(text="Выбрать другую книгу", callback_data="action_book")
     builder.adjust(1)
     return builder.as_markup()
 
+@cache
 def get_book_again_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="Забронировать ещё", callback_data="action_book")
@@ -578,18 +827,111 @@ def get_book_again_keyboard():
     return builder.as_markup()
 
 # ------------------------------ Вспомогательные функции ------------------------------
+class RateLimiter:
+    """Пропускает не больше rate вызовов за period секунд"""
+
+    def __init__(self, rate: int, period: float = 1.0):
+        self.rate = rate
+        self.period = period
+        self._sent: Deque[float] = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while len(self._sent) >= self.rate:
+                wait = self._sent[0] + self.period - monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._sent.popleft()
+            self._sent.append(monotonic())
+
+# Telegram допускает ~30 сообщений в секунду на бота. Массовым отправкам (рассылка, напоминания,
+# уведомления группы) отдаём 25, остаток — ответам пользователям, которые не ждут в общей очереди.
+_bulk_limiter = RateLimiter(25)
+
+# Задача, выставившая флаг, отправляет массово: её сообщения идут через _bulk_limiter
+bulk_send: ContextVar[bool] = ContextVar("bulk_send", default=False)
+
+# Методы, создающие сообщения
+RATE_LIMITED_METHODS = (SendMessage, CopyMessage, SendPhoto, SendDocument)
+
+async def send_rate_middleware(make_request, bot: Bot, method):
+    if bulk_send.get() and isinstance(method, RATE_LIMITED_METHODS):
+        await _bulk_limiter.acquire()
+    return await make_request(bot, method)
+
+bot.session.middleware(send_rate_middleware)
+
+# Уведомления группы о бронях, возвратах и продлениях: (текст, file_id фото или None).
+# Их отправляет audit_worker, чтобы ответ пользователю не ждал отправки в группу.
+audit_queue: asyncio.Queue = asyncio.Queue()
+
+# Всплеск уведомлений склеивается в одно сообщение (группе Telegram разрешает ~20 сообщений в минуту)
+AUDIT_BATCH_SIZE = 10
+AUDIT_BATCH_WAIT = 2
+
+def audit(text: str, photo: Optional[str] = None):
+    audit_queue.put_nowait((text, photo))
+
+async def send_audit(text: str, photo: Optional[str] = None):
+    try:
+        if photo:
+            await bot.send_photo(CFG.group_chat_id, photo, caption=text)
+        else:
+            await bot.send_message(CFG.group_chat_id, text)
+    except Exception as e:
+        logger.error(f"Ошибка отправки уведомления в группу: {e}")
+
+async def audit_worker():
+    bulk_send.set(True)
+    while True:
+        batch = [await audit_queue.get()]
+        deadline = monotonic() + AUDIT_BATCH_WAIT
+        while len(batch) < AUDIT_BATCH_SIZE:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(audit_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Тексты подряд идут одним сообщением; фото отправляются отдельно, порядок сохраняется
+        texts = []
+        for text, photo in batch:
+            if photo:
+                if texts:
+                    await send_audit("\n".join(texts))
+                    texts = []
+                await send_audit(text, photo)
+            else:
+                texts.append(text)
+        if texts:
+            await send_audit("\n".join(texts))
+
+def format_location(shelf, floor) -> str:
+    """Суффикс с местом книги или пустая строка, если место неизвестно"""
+    if shelf is None or floor is None:
+        return ""
+    return f" (полка {shelf}, этаж {floor})"
+
 def format_books_list(books):
     if not books:
         return "В этом офисе сейчас нет доступных книг."
-    result = "📚 Доступные книги в этом офисе:\n\n"
-    for i, book in enumerate(books, 1):
-        result += f"{i}. {book['title']} - {book['author']}"
-        if book.get('shelf') and book.get('floor'):
-            result += f" (полка {book['shelf']}, этаж {book['floor']})"
-        result += "\n"
-    return result
+    lines = ["📚 Доступные книги в этом офисе:\n"]
+    lines.extend(
+        f"{i}. {book['title']} - {book['author']}"
+        f"{format_location(book['shelf'], book['floor'])}"
+        for i, book in enumerate(books, 1)
+    )
+    return "\n".join(lines)
 
 async def safe_edit_message(message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    # Текущее содержимое приходит вместе с callback — "not modified" видно без запроса к Telegram
+    if message.text == text and message.reply_markup == reply_markup:
+        logger.warning("Сообщение не изменено – отправляем новое")
+        await message.answer(text, reply_markup=reply_markup)
+        return
     try:
         await message.edit_text(text, reply_markup=reply_markup)
     except TelegramBadRequest as e:
@@ -599,9 +941,9 @@ async def safe_edit_message(message, text: str, reply_markup: Optional[InlineKey
         else:
             raise
 
-async def process_start_booking(message: Message, state: FSMContext):
-    """Общая логика начала бронирования"""
-    user_info = await get_user_info(message.from_user.id)
+async def process_start_booking(message: Message, state: FSMContext, user_id: Optional[int] = None):
+    """Общая логика начала бронирования. user_id нужен, когда message — сообщение бота (из callback)"""
+    user_info = await get_user_context(user_id or message.from_user.id)
     if not user_info:
         await message.answer(
             "Похоже, мы с вами ещё не знакомились. Напишите, пожалуйста, ваши Имя и Фамилию через пробел",
@@ -612,10 +954,9 @@ async def process_start_booking(message: Message, state: FSMContext):
 
     first_name = user_info['first_name']
     office = user_info['office']
-    booking_info = await get_user_booking(message.from_user.id)
-    if booking_info and booking_info.get('booking_id'):
-        current_book = booking_info['book_title']
-        duration = booking_info['booking_duration']
+    if user_info['booking_id'] is not None:
+        current_book = user_info['book_title']
+        duration = user_info['booking_duration']
         await message.answer(
             f"{first_name}, у вас уже есть активное бронирование книги '{current_book}' на срок {duration}. "
             f"Сначала верни эту книгу, прежде чем бронировать новую.",
@@ -639,145 +980,331 @@ async def process_start_booking(message: Message, state: FSMContext):
         await state.set_state(UserStates.waiting_for_office)
         await state.update_data(first_name=first_name)
 
+# ------------------------------ Очередь напоминаний ------------------------------
+# Куча (время срабатывания, ID брони, вид напоминания). У каждой брони в очереди только следующее
+# напоминание (reminder_next); после отправки планируется следующее. Записи, не совпадающие
+# с reminder_next (бронь продлили), считаются устаревшими. check_reminders спит до ближайшего
+# срабатывания или до reminder_wakeup.
+reminder_heap: List[Tuple[datetime, int, str]] = []
+reminder_next: Dict[int, Tuple[datetime, str]] = {}
+# ID брони -> время последней просьбы вернуть книгу; запись удаляется, когда бронь завершена
+last_ended_reminder: Dict[int, datetime] = {}
+reminder_wakeup = asyncio.Event()
+
+REMINDER_HOUR = time(9)
+REMINDER_GRACE = timedelta(hours=1)
+ENDED_REPEAT = timedelta(hours=2)
+OVERDUE_AFTER = timedelta(days=1)
+REMINDER_RETRY = timedelta(seconds=10)
+# Не удалось отправить сообщение о просрочке в группу — повторяем с такой паузой
+OVERDUE_RETRY = timedelta(minutes=10)
+REMINDER_MAX_SLEEP = 3600
+# Через столько после окончания брони напоминать о возврате перестаём
+REMINDER_HORIZON = timedelta(days=30)
+
+# вид напоминания -> (текст, кнопка возврата, parse_mode)
+REMINDER_MESSAGES = {
+    "1h_15min": ("*Не забудьте вернуть книгу '{book}' через 15 минут*", True, "Markdown"),
+    "wk_day5": ("Не забудьте вернуть книгу '{book}' завтра", True, None),
+    "wk_day6": ("Не забудьте вернуть книгу '{book}' сегодня", True, None),
+    "m_day21": ("Не забудьте вернуть книгу '{book}' через неделю", False, None),
+    "m_day27": ("Не забудьте вернуть книгу '{book}' сегодня", True, None),
+    "3m_week": ("Не забудьте вернуть книгу '{book}' через неделю", False, None),
+    "3m_day": ("Не забудьте вернуть книгу '{book}' завтра", True, None),
+    "6m_month": ("Не забудьте вернуть книгу '{book}' через месяц", False, None),
+    "6m_week": ("Не забудьте вернуть книгу '{book}' через неделю", False, None),
+    "6m_day": ("Не забудьте вернуть книгу '{book}' завтра", True, None),
+}
+
+# длительность -> [(вид, отсчёт от начала брони (иначе от конца), смещение, в REMINDER_HOUR)]
+REMINDER_SCHEDULE: Dict[str, List[Tuple[str, bool, timedelta, bool]]] = {
+    "1 час": [("1h_15min", False, -timedelta(minutes=15), False)],
+    "1 неделя": [
+        ("wk_day5", True, timedelta(days=5), True),
+        ("wk_day6", True, timedelta(days=6), True),
+    ],
+    "1 месяц": [
+        ("m_day21", True, timedelta(days=21), True),
+        ("m_day27", True, timedelta(days=27), True),
+    ],
+    "3 месяца": [
+        ("3m_week", False, -timedelta(days=7), True),
+        ("3m_day", False, -timedelta(days=1), True),
+    ],
+    "6 месяцев": [
+        ("6m_month", False, -timedelta(days=30), True),
+        ("6m_week", False, -timedelta(days=7), True),
+        ("6m_day", False, -timedelta(days=1), True),
+    ],
+}
+
+def at_reminder_hour(moment: datetime) -> datetime:
+    # replace() не создаёт промежуточных date/time, как datetime.combine(moment.date(), ...)
+    return moment.replace(hour=REMINDER_HOUR.hour, minute=REMINDER_HOUR.minute, second=0, microsecond=0)
+
+def reminder_plan(start: datetime, end: datetime, duration: str) -> List[Tuple[datetime, str]]:
+    """Напоминания брони до окончания и само окончание"""
+    plan = []
+    for kind, from_start, offset, morning in REMINDER_SCHEDULE.get(duration, ()):
+        fire_at = (start if from_start else end) + offset
+        plan.append((at_reminder_hour(fire_at) if morning else fire_at, kind))
+    plan.append((end, "ended"))
+    return plan
+
+def next_reminder(start: datetime, end: datetime, duration: str, after: datetime,
+                  overdue_notified: bool) -> Tuple[datetime, str]:
+    """Ближайшее напоминание брони позже момента after"""
+    if after < end:
+        for fire_at, kind in reminder_plan(start, end, duration):
+            if fire_at > after:
+                return fire_at, kind
+    # После окончания просьба вернуть книгу повторяется, плюс одно сообщение группе о просрочке
+    repeat_at = after + ENDED_REPEAT
+    overdue_at = end + OVERDUE_AFTER
+    if not overdue_notified and overdue_at <= repeat_at:
+        return overdue_at, "overdue"
+    return repeat_at, "ended"
+
+def push_reminder(fire_at: datetime, booking_id: int, kind: str):
+    reminder_next[booking_id] = (fire_at, kind)
+    heapq.heappush(reminder_heap, (fire_at, booking_id, kind))
+    reminder_wakeup.set()
+
+def cancel_reminders(booking_id: int):
+    """Снимает напоминания завершённой брони; её запись в куче станет устаревшей"""
+    reminder_next.pop(booking_id, None)
+    last_ended_reminder.pop(booking_id, None)
+
+def drop_stale_reminders():
+    """Убирает устаревшие записи с вершины кучи, чтобы не просыпаться ради них"""
+    while reminder_heap:
+        fire_at, booking_id, kind = reminder_heap[0]
+        if reminder_next.get(booking_id) == (fire_at, kind):
+            return
+        heapq.heappop(reminder_heap)
+
+def schedule_reminders(booking_id: int, start: datetime, end: datetime, duration: str,
+                       overdue_notified: bool = False, now: Optional[datetime] = None):
+    """Ставит в очередь ближайшее напоминание брони, заменяя запланированное ранее"""
+    now = now or datetime.now()
+    if now >= end:
+        push_reminder(end, booking_id, "ended")
+    else:
+        # Напоминание, пропущенное больше чем на REMINDER_GRACE, не отправляем
+        fire_at, kind = next_reminder(start, end, duration, now - REMINDER_GRACE, overdue_notified)
+        push_reminder(fire_at, booking_id, kind)
+
+async def restore_reminders():
+    """Восстанавливает очередь напоминаний по активным броням после перезапуска"""
+    now = datetime.now()
+    async with db.pool.acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT b.id as booking_id, b.start_time, b.duration, b.end_time, b.overdue_notified
+            FROM users u
+            JOIN bookings b ON u.user_id = b.user_id AND b.status = 'active'
+            WHERE u.status = 'booked' AND u.booking_end IS NOT NULL AND b.end_time > $1
+        ''', now - REMINDER_HORIZON)
+    for rec in rows:
+        if rec['start_time'] and rec['end_time']:
+            schedule_reminders(
+                rec['booking_id'], rec['start_time'], rec['end_time'],
+                rec['duration'], rec['overdue_notified'], now
+            )
+    logger.info(f"Восстановлено напоминаний для {len(rows)} активных броней")
+
 # ------------------------------ Фоновая задача напоминаний ------------------------------
+async def send_reminder(rec: asyncpg.Record, kind: str, now: datetime):
+    """Отправляет одно наступившее напоминание по уже загруженной брони"""
+    if not rec['booking_start'] or not rec['booking_end']:
+        return
+
+    booking_id = rec['booking_id']
+    uid = rec['user_id']
+    book = rec['book_title']
+    end = rec['booking_end']
+
+    # ----- Бронь закончилась -----
+    if kind == "ended":
+        if now < end:
+            return
+        last = last_ended_reminder.get(booking_id)
+        if last is not None and (now - last) < ENDED_REPEAT:
+            return
+        await bot.send_message(
+            uid,
+            f"Бронь книги '{book}' закончилась. Пожалуйста, верните книгу.",
+            reply_markup=get_booking_ended_keyboard(book, booking_id, not rec['extension_made'])
+        )
+        last_ended_reminder[booking_id] = now
+
+    # ----- Просрочка более суток -----
+    elif kind == "overdue":
+        async with db.pool.acquire() as conn:
+            claimed = await conn.fetchval(HOT_SQL["claim_overdue"], booking_id, OVERDUE_AFTER, now)
+        if claimed is None:
+            return
+        try:
+            await bot.send_message(
+                CFG.group_chat_id,
+                f"🆘️ Просрочка: пользователь {rec['first_name']} {rec['last_name']} (ID: {uid}) "
+                f"не вернул книгу '{book}' спустя сутки от окончания бронирования"
+            )
+        except Exception:
+            await db.pool.execute('UPDATE bookings SET overdue_notified = FALSE WHERE id = $1', booking_id)
+            raise
+
+    # ----- Напоминания до окончания -----
+    else:
+        if now >= end:
+            return
+        text, with_return, parse_mode = REMINDER_MESSAGES[kind]
+        await bot.send_message(
+            uid,
+            text.format(book=book),
+            parse_mode=parse_mode,
+            reply_markup=get_return_book_keyboard(book) if with_return else None
+        )
+
+async def run_reminder(rec: asyncpg.Record, kind: str, now: datetime) -> bool:
+    """False — напоминание не удалось отправить"""
+    try:
+        await send_reminder(rec, kind, now)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка напоминания '{kind}' по брони {rec['booking_id']}: {e}")
+        return False
+
 async def check_reminders():
+    bulk_send.set(True)
+    db_down = False
     while True:
+        reminder_wakeup.clear()
+        drop_stale_reminders()
+        # Сон ограничен часом: время срабатывания считается по системным часам,
+        # и их перевод не должен задержать напоминания на дни
+        timeout = None
+        if reminder_heap:
+            timeout = min(max((reminder_heap[0][0] - datetime.now()).total_seconds(), 0), REMINDER_MAX_SLEEP)
+        try:
+            # Новая бронь или продление будят цикл, чтобы пересчитать ближайшее срабатывание
+            await asyncio.wait_for(reminder_wakeup.wait(), timeout=timeout)
+            continue
+        except asyncio.TimeoutError:
+            pass
+
+        now = datetime.now()
+        due = []
+        while reminder_heap and reminder_heap[0][0] <= now:
+            fire_at, booking_id, kind = heapq.heappop(reminder_heap)
+            # Бронь перепланировали (продление) — устаревшую запись пропускаем
+            if reminder_next.get(booking_id) == (fire_at, kind):
+                del reminder_next[booking_id]
+                due.append((fire_at, booking_id, kind))
+        if not due:
+            continue
+
+        # Брони всех наступивших напоминаний читаем одним запросом;
+        # завершённых броней в выборке нет — их напоминания отбрасываются
         try:
             async with db.pool.acquire() as conn:
-                rows = await conn.fetch('''
-                    SELECT u.user_id, u.first_name, u.last_name, u.office,
-                           b.id as booking_id, b.book_id, b.book_title, b.start_time as booking_start,
-                           b.duration as booking_duration, b.end_time as booking_end,
-                           b.extension_made, b.overdue_notified
-                    FROM users u
-                    JOIN bookings b ON u.user_id = b.user_id AND b.status = 'active'
-                    WHERE u.status = 'booked' AND u.booking_end IS NOT NULL
-                ''')
-                now = datetime.now()
-
-                for rec in rows:
-                    uid = rec['user_id']
-                    bid = rec['booking_id']
-                    book = rec['book_title']
-                    start = rec['booking_start']
-                    dur = rec['booking_duration']
-                    end = rec['booking_end']
-                    fname = rec['first_name']
-                    ext_made = rec['extension_made']
-                    overdue_not = rec['overdue_notified']
-
-                    if not start or not end:
-                        continue
-
-                    last_key = f"last_reminder_{uid}_{bid}"
-
-                    # ----- Напоминания до окончания -----
-                    if dur == "1 час":
-                        remind_15 = end - timedelta(minutes=15)
-                        if now >= remind_15 and now < end:
-                            await bot.send_message(
-                                uid,
-                                f"*Не забудьте вернуть книгу '{book}' через 15 минут*",
-                                parse_mode="Markdown",
-                                reply_markup=get_return_book_keyboard(book)
-                            )
-                    elif dur == "1 неделя":
-                        day5 = start + timedelta(days=5)
-                        if now.date() == day5.date() and now.hour == 9:
-                            await bot.send_message(
-                                uid,
-                                f"Не забудьте вернуть книгу '{book}' завтра",
-                                reply_markup=get_return_book_keyboard(book)
-                            )
-                        day6 = start + timedelta(days=6)
-                        if now.date() == day6.date() and now.hour == 9:
-                            await bot.send_message(
-                                uid,
-                                f"Не забудьте вернуть книгу '{book}' сегодня",
-                                reply_markup=get_return_book_keyboard(book)
-                            )
-                    elif dur == "1 месяц":
-                        day21 = start + timedelta(days=21)
-                        if now.date() == day21.date() and now.hour == 9:
-                            await bot.send_message(uid, f"Не забудьте вернуть книгу '{book}' через неделю")
-                        day27 = start + timedelta(days=27)
-                        if now.date() == day27.date() and now.hour == 9:
-                            await bot.send_message(
-                                uid,
-                                f"Не забудьте вернуть книгу '{book}' сегодня",
-                                reply_markup=get_return_book_keyboard(book)
-                            )
-                    elif dur == "3 месяца":
-                        week_before = end - timedelta(days=7)
-                        if now.date() == week_before.date() and now.hour == 9:
-                            await bot.send_message(uid, f"Не забудьте вернуть книгу '{book}' через неделю")
-                        day_before = end - timedelta(days=1)
-                        if now.date() == day_before.date() and now.hour == 9:
-                            await bot.send_message(
-                                uid,
-                                f"Не забудьте вернуть книгу '{book}' завтра",
-                                reply_markup=get_return_book_keyboard(book)
-                            )
-                    elif dur == "6 месяцев":
-                        month_before = end - timedelta(days=30)
-                        if now.date() == month_before.date() and now.hour == 9:
-                            await bot.send_message(uid, f"Не забудьте вернуть книгу '{book}' через месяц")
-                        week_before = end - timedelta(days=7)
-                        if now.date() == week_before.date() and now.hour == 9:
-                            await bot.send_message(uid, f"Не забудьте вернуть книгу '{book}' через неделю")
-                        day_before = end - timedelta(days=1)
-                        if now.date() == day_before.date() and now.hour == 9:
-                            await bot.send_message(
-                                uid,
-                                f"Не забудьте вернуть книгу '{book}' завтра",
-                                reply_markup=get_return_book_keyboard(book)
-                            )
-
-                    # ----- Бронь закончилась -----
-                    if now >= end:
-                        last = getattr(check_reminders, last_key, None)
-                        if last is None or (now - last) >= timedelta(hours=2):
-                            builder = InlineKeyboardBuilder()
-                            builder.button(text=f"Вернуть книгу {book}", callback_data=f"return_{book}")
-                            if not ext_made:
-                                builder.button(text="⏳ Продлить бронь", callback_data=f"extend_{bid}")
-                            builder.adjust(1)
-                            await bot.send_message(
-                                uid,
-                                f"Бронь книги '{book}' закончилась. Пожалуйста, верните книгу.",
-                                reply_markup=builder.as_markup()
-                            )
-                            setattr(check_reminders, last_key, now)
-
-                    # ----- Просрочка более суток -----
-                    if now >= end + timedelta(days=1) and not overdue_not:
-                        await bot.send_message(
-                            GROUP_CHAT_ID,
-                            f"🆘️ Просрочка: пользователь {fname} {rec['last_name']} (ID: {uid}) "
-                            f"не вернул книгу '{book}' спустя сутки от окончания бронирования"
-                        )
-                        await conn.execute(
-                            'UPDATE bookings SET overdue_notified = TRUE WHERE id = $1',
-                            bid
-                        )
-
+                rows = await conn.fetch(HOT_SQL["due_bookings"], list({booking_id for _, booking_id, _ in due}))
         except Exception as e:
-            logger.error(f"Ошибка в check_reminders: {e}")
+            # БД недоступна: пишем в лог один раз за сбой и повторяем через REMINDER_RETRY,
+            # не теряя цепочки напоминаний
+            if not db_down:
+                logger.warning(f"БД недоступна, напоминания отложены: {e}")
+                db_down = True
+            for _, booking_id, kind in due:
+                push_reminder(now + REMINDER_RETRY, booking_id, kind)
+            continue
+        if db_down:
+            logger.info("Связь с БД восстановлена, напоминания возобновлены")
+            db_down = False
+        bookings = {rec['booking_id']: rec for rec in rows}
+        for _, booking_id, _ in due:
+            if booking_id not in bookings:
+                last_ended_reminder.pop(booking_id, None)
+
+        # Все наступившие напоминания (например, утренние в 09:00) отправляем параллельно;
+        # ошибка по одной брони не мешает остальным
+        tasks = {}
+        async with asyncio.TaskGroup() as tg:
+            for _, booking_id, kind in due:
+                if booking_id in bookings:
+                    tasks[booking_id] = tg.create_task(run_reminder(bookings[booking_id], kind, now))
+
+        # Планируем следующее напоминание, если бронь не перепланировали во время отправки
+        for _, booking_id, kind in due:
+            rec = bookings.get(booking_id)
+            if rec is None or booking_id in reminder_next or not rec['booking_start'] or not rec['booking_end']:
+                continue
+            if rec['booking_end'] + REMINDER_HORIZON <= now:
+                last_ended_reminder.pop(booking_id, None)
+                continue
+            # Сообщение о просрочке не ушло (отметка сброшена) — повторяем его, а не следующий этап
+            if kind == "overdue" and not tasks[booking_id].result():
+                push_reminder(now + OVERDUE_RETRY, booking_id, "overdue")
+                continue
+            fire_at, next_kind = next_reminder(
+                rec['booking_start'], rec['booking_end'], rec['booking_duration'],
+                now, rec['overdue_notified'] or kind == "overdue"
+            )
+            push_reminder(fire_at, booking_id, next_kind)
+
+# ------------------------------ Маршрутизация callback-запросов ------------------------------
+CallbackHandler = Callable[[CallbackQuery, FSMContext], Awaitable[Any]]
+
+# Точные значения callback_data и префиксы (ключ — callback_key префикса).
+# Для каждого ключа обработчики хранятся в порядке регистрации вместе с требуемым состоянием.
+CALLBACK_EXACT: Dict[str, List[Tuple[Optional[str], CallbackHandler]]] = {}
+CALLBACK_PREFIX: Dict[str, List[Tuple[str, Optional[str], CallbackHandler]]] = {}
+
+
+def callback_key(data: str) -> str:
+    """Часть callback_data до первого "_" (или ":" у CallbackData)"""
+    return data.split("_", 1)[0].split(":", 1)[0]
+
+
+def cb(data: str, state: Optional[State] = None):
+    """Регистрирует обработчик точного значения callback_data"""
+    def wrap(handler: CallbackHandler) -> CallbackHandler:
+        CALLBACK_EXACT.setdefault(data, []).append((state.state if state else None, handler))
+        return handler
+    return wrap
+
+
+def cb_prefix(prefix: str, state: Optional[State] = None):
+    """Регистрирует обработчик callback_data, начинающихся с prefix"""
+    def wrap(handler: CallbackHandler) -> CallbackHandler:
+        key = callback_key(prefix)
+        CALLBACK_PREFIX.setdefault(key, []).append((prefix, state.state if state else None, handler))
+        return handler
+    return wrap
 
-        await asyncio.sleep(300)
+
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext):
+    data = callback.data or ""
+    current = await state.get_state()
+    # Сначала точное совпадение, затем префикс — как в прежнем порядке регистрации
+    for required, handler in CALLBACK_EXACT.get(data, ()):
+        if required is None or required == current:
+            return await handler(callback, state)
+    for prefix, required, handler in CALLBACK_PREFIX.get(callback_key(data), ()):
+        if data.startswith(prefix) and (required is None or required == current):
+            return await handler(callback, state)
 
 # ------------------------------ Обработчики команд и сообщений ------------------------------
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
-    user_info = await get_user_info(message.from_user.id)
+    user_info = await get_user_context(message.from_user.id)
     if user_info:
         first_name = user_info['first_name']
         office = user_info['office']
         rules_accepted = user_info.get('rules_accepted', False)
-        booking_info = await get_user_booking(message.from_user.id)
-        has_booking = booking_info is not None and booking_info.get('booking_id') is not None
-        current_book = booking_info['book_title'] if has_booking else None
+        has_booking = user_info['booking_id'] is not None
+        current_book = user_info['book_title']
 
         if rules_accepted:
             await update_commands_on_start(message.from_user.id, has_booking, current_book)
@@ -827,26 +1354,18 @@ async def cmd_rules(message: Message, state: FSMContext):
 
 @router.message(Command("return"))
 async def cmd_return(message: Message, state: FSMContext):
-    uid = message.from_user.id
-    booking_info = await get_user_booking(uid)
-    if not booking_info or not booking_info.get('booking_id'):
+    user_info = await get_user_context(message.from_user.id)
+    if not user_info or user_info['booking_id'] is None:
         await message.answer("❌ У вас нет активных бронирований.")
         return
-    book_title = booking_info['book_title']
-    booking_id = booking_info['booking_id']
-    book_id = booking_info['book_id']
-    user_info = await get_user_info(uid)
-    if not user_info:
-        await message.answer("❌ Ошибка: пользователь не найден.")
-        return
     await state.set_state(UserStates.waiting_for_photo)
     await state.update_data(
-        book_title=book_title,
+        book_title=user_info['book_title'],
         office=user_info['office'],
         first_name=user_info['first_name'],
         last_name=user_info['last_name'],
-        booking_id=booking_id,
-        book_id=book_id
+        booking_id=user_info['booking_id'],
+        book_id=user_info['book_id']
     )
     await message.answer("📸 Отправьте, пожалуйста, фотографию книги в библиотеке")
 
@@ -858,13 +1377,12 @@ async def cmd_book(message: Message, state: FSMContext):
 @router.message(Command("request"))
 async def cmd_request(message: Message, state: FSMContext):
     uid = message.from_user.id
-    booking_info = await get_user_booking(uid)
-    if booking_info and booking_info.get('booking_id'):
+    user_info = await get_user_context(uid)
+    if user_info and user_info['booking_id'] is not None:
         await message.answer("❌ У вас уже есть активное бронирование. Сначала верните книгу.")
         return
 
     await remove_book_command(uid)
-    user_info = await get_user_info(uid)
     if not user_info:
         await message.answer("❌ Ошибка: пользователь не найден. Напишите /start")
         return
@@ -901,7 +1419,7 @@ async def process_name(message: Message, state: FSMContext):
     )
     await state.set_state(UserStates.waiting_for_accept_rules)
 
-@router.callback_query(StateFilter(UserStates.waiting_for_accept_rules), F.data == "accept_rules")
+@cb("accept_rules", UserStates.waiting_for_accept_rules)
 async def process_accept_rules(callback: CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
     await accept_rules(uid)
@@ -946,14 +1464,9 @@ async def ignore_text_in_button_states(message: Message):
         "Текстовые сообщения в этом состоянии не обрабатываются."
     )
 
-@router.callback_query(StateFilter(UserStates.waiting_for_office), F.data.startswith("office_"))
+@cb_prefix("office_", UserStates.waiting_for_office)
 async def process_office(callback: CallbackQuery, state: FSMContext):
-    office_map = {
-        "office_stone": "Stone Towers",
-        "office_manhatten": "Manhatten",
-        "office_izvestia": "Известия"
-    }
-    office = office_map.get(callback.data)
+    office = OFFICE_CALLBACKS.get(callback.data)
     if not office:
         await callback.answer("Неверный выбор офиса")
         return
@@ -965,12 +1478,17 @@ async def process_office(callback: CallbackQuery, state: FSMContext):
     )
     await state.set_state(UserStates.waiting_for_book_title)
 
-@router.callback_query(StateFilter(UserStates.waiting_for_book_title), F.data == "action_book")
+@cb("action_book")
 async def process_action_book(callback: CallbackQuery, state: FSMContext):
-    await callback.message.edit_text("Напишите, пожалуйста, название книги")
-    await state.set_state(UserStates.waiting_for_book_title)
+    # В диалоге выбора книги просто просим название, иначе (кнопка из уведомления) начинаем бронирование
+    if await state.get_state() == UserStates.waiting_for_book_title.state:
+        await callback.message.edit_text("Напишите, пожалуйста, название книги")
+        return
+    await remove_book_command(callback.from_user.id)
+    await process_start_booking(callback.message, state, callback.from_user.id)
+    await callback.answer()
 
-@router.callback_query(StateFilter(UserStates.waiting_for_book_title), F.data == "action_list")
+@cb("action_list", UserStates.waiting_for_book_title)
 async def process_action_list(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     office = data.get('office')
@@ -1006,8 +1524,12 @@ async def process_book_title(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    #Проверяем, есть ли такая книга в офисе
-    book_any = await get_book_by_title_any_status(title_input, office)
+    async with db.pool.acquire() as conn:
+        #Проверяем, есть ли такая книга в офисе
+        book_any = await get_book_by_title_any_status(title_input, office, conn)
+        #Проверяем, есть ли доступный экземпляр
+        available_book = await get_available_book_instance(title_input, office, conn) if book_any else None
+
     if not book_any:
         await message.answer(
             "Такой книги нет в нашей библиотеке. "
@@ -1017,8 +1539,6 @@ async def process_book_title(message: Message, state: FSMContext):
         await state.set_state(UserStates.waiting_for_confirmation)
         return
 
-    #Проверяем, есть ли доступный экземпляр
-    available_book = await get_available_book_instance(title_input, office)
     if not available_book:
         #Книга есть, но все экземпляры заняты → лист ожидания
         await message.answer(
@@ -1056,7 +1576,7 @@ async def process_book_title(message: Message, state: FSMContext):
     await message.answer(msg, reply_markup=get_confirmation_keyboard())
     await state.set_state(UserStates.waiting_for_confirmation)
 
-@router.callback_query(StateFilter(UserStates.waiting_for_waitlist_choice), F.data == "waitlist_add")
+@cb("waitlist_add", UserStates.waiting_for_waitlist_choice)
 async def process_waitlist_add(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     book_title = data.get('book_title')
@@ -1070,11 +1590,9 @@ async def process_waitlist_add(callback: CallbackQuery, state: FSMContext):
             f"Вы добавлены в лист ожидания для книги '{book_title}'. "
             f"Я уведомлю вас, когда книга освободится."
         )
-        builder = InlineKeyboardBuilder()
-        builder.button(text="Выбрать другую книгу", callback_data="action_book")
         await callback.message.answer(
             "Вы можете выбрать другую книгу, пока ждёте освобождения этой:",
-            reply_markup=builder.as_markup()
+            reply_markup=get_choose_other_keyboard()
         )
     else:
         await callback.message.edit_text(
@@ -1082,7 +1600,7 @@ async def process_waitlist_add(callback: CallbackQuery, state: FSMContext):
         )
     await state.clear()
 
-@router.callback_query(StateFilter(UserStates.waiting_for_waitlist_choice), F.data == "waitlist_other")
+@cb("waitlist_other", UserStates.waiting_for_waitlist_choice)
 async def process_waitlist_other(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     first_name = data.get('first_name')
@@ -1093,8 +1611,24 @@ async def process_waitlist_other(callback: CallbackQuery, state: FSMContext):
     )
     await state.set_state(UserStates.waiting_for_book_title)
 
-@router.callback_query(F.data.startswith("waitlist_book_"))
+@cb_prefix("wl:")
 async def process_waitlist_book(callback: CallbackQuery, state: FSMContext):
+    try:
+        freed_id = WaitlistCB.unpack(callback.data).book_id
+    except (TypeError, ValueError):
+        await callback.answer("Ошибка в данных")
+        return
+
+    async with db.pool.acquire() as conn:
+        user_info = await get_user_info(callback.from_user.id, conn)
+        # Проверяем, есть ли доступный экземпляр
+        available_book = await get_available_copy_of(freed_id, conn) if user_info else None
+    await offer_waitlist_book(callback, state, user_info, available_book)
+
+# Кнопки, разосланные до перехода на WaitlistCB: waitlist_book_<название>_<офис>.
+# Оставлены на один релиз, чтобы старые уведомления не зависали.
+@cb_prefix("waitlist_book_")
+async def process_legacy_waitlist_book(callback: CallbackQuery, state: FSMContext):
     parts = callback.data.split("_")
     if len(parts) < 4:
         await callback.answer("Ошибка в данных")
@@ -1102,19 +1636,27 @@ async def process_waitlist_book(callback: CallbackQuery, state: FSMContext):
     book_title = "_".join(parts[2:-1])
     office = parts[-1]
 
-    user_info = await get_user_info(callback.from_user.id)
+    async with db.pool.acquire() as conn:
+        user_info = await get_user_info(callback.from_user.id, conn)
+        available_book = await get_available_book_instance(book_title, office, conn) if user_info else None
+    if available_book:
+        available_book = dict(available_book, office=office)
+    await offer_waitlist_book(callback, state, user_info, available_book)
+
+async def offer_waitlist_book(callback: CallbackQuery, state: FSMContext, user_info, available_book):
+    """Предлагает забронировать освободившуюся книгу из листа ожидания"""
     if not user_info:
         await callback.answer("Ошибка: пользователь не найден")
         return
     first_name = user_info['first_name']
 
-    # Проверяем, есть ли доступный экземпляр
-    available_book = await get_available_book_instance(book_title, office)
     if not available_book:
         await callback.answer("❌ Книга больше не доступна", show_alert=True)
         return
 
     book_id = available_book['id']
+    book_title = available_book['title']
+    office = available_book['office']
     shelf = available_book.get('shelf')
     floor = available_book.get('floor')
     author = available_book['author']
@@ -1135,7 +1677,7 @@ async def process_waitlist_book(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text(msg, reply_markup=get_confirmation_keyboard())
     await state.set_state(UserStates.waiting_for_confirmation)
 
-@router.callback_query(StateFilter(UserStates.waiting_for_confirmation), F.data == "confirm_yes")
+@cb("confirm_yes", UserStates.waiting_for_confirmation)
 async def process_confirmation_yes(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     first_name = data.get('first_name')
@@ -1146,19 +1688,15 @@ async def process_confirmation_yes(callback: CallbackQuery, state: FSMContext):
     )
     await state.set_state(UserStates.waiting_for_duration)
 
-@router.callback_query(StateFilter(UserStates.waiting_for_confirmation), F.data == "confirm_no")
+@cb("confirm_no", UserStates.waiting_for_confirmation)
 async def process_confirmation_no(callback: CallbackQuery, state: FSMContext):
-    builder = InlineKeyboardBuilder()
-    builder.button(text="Не бронирую", callback_data="return_cancel")
-    builder.button(text="Забронировать другую", callback_data="return_another")
-    builder.adjust(1)
     await callback.message.edit_text(
         "Вы не будете бронировать книгу или хотите выбрать другую?",
-        reply_markup=builder.as_markup()
+        reply_markup=get_return_options_keyboard()
     )
     await state.set_state(UserStates.waiting_for_confirmation)
 
-@router.callback_query(StateFilter(UserStates.waiting_for_confirmation), F.data == "return_cancel")
+@cb("return_cancel", UserStates.waiting_for_confirmation)
 async def process_return_cancel(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     first_name = data.get('first_name', '')
@@ -1170,7 +1708,7 @@ async def process_return_cancel(callback: CallbackQuery, state: FSMContext):
     )
     await state.clear()
 
-@router.callback_query(StateFilter(UserStates.waiting_for_confirmation), F.data == "return_another")
+@cb("return_another", UserStates.waiting_for_confirmation)
 async def process_return_another(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Вы уже определились с выбором книги для бронирования или хотите сначала ознакомиться со списком доступных книг?",
@@ -1178,16 +1716,9 @@ async def process_return_another(callback: CallbackQuery, state: FSMContext):
     )
     await state.set_state(UserStates.waiting_for_book_title)
 
-@router.callback_query(StateFilter(UserStates.waiting_for_duration), F.data.startswith("duration_"))
+@cb_prefix("duration_", UserStates.waiting_for_duration)
 async def process_duration(callback: CallbackQuery, state: FSMContext):
-    duration_map = {
-        "duration_1h": "1 час",
-        "duration_1w": "1 неделя",
-        "duration_1m": "1 месяц",
-        "duration_3m": "3 месяца",
-        "duration_6m": "6 месяцев"
-    }
-    dur = duration_map.get(callback.data)
+    dur = DURATION_CALLBACKS.get(callback.data)
     if not dur:
         await callback.answer("Неверный выбор длительности")
         return
@@ -1209,8 +1740,7 @@ async def process_duration(callback: CallbackQuery, state: FSMContext):
         user_info = await get_user_info(callback.from_user.id)
         if user_info:
             last_name = user_info['last_name']
-            await bot.send_message(
-                GROUP_CHAT_ID,
+            audit(
                 f"✅️ Бронирование: Пользователь {first_name} {last_name} (ID: {callback.from_user.id}) "
                 f"забронировал книгу '{book_title}' на срок {dur}"
             )
@@ -1219,20 +1749,19 @@ async def process_duration(callback: CallbackQuery, state: FSMContext):
             f"{first_name}, вы бронируете книгу '{book_title}' на {dur}.",
             reply_markup=get_finish_booking_keyboard()
         )
-        await state.update_data(book_title=book_title, duration=dur, office=office, first_name=first_name)
+        # Название, офис и имя уже лежат в состоянии — дописываем только срок
+        await state.update_data(duration=dur)
         await state.set_state(UserStates.waiting_for_booking_confirmation)
     except Exception as e:
         logger.error(f"Ошибка создания бронирования: {e}")
-        builder = InlineKeyboardBuilder()
-        builder.button(text="Попробовать снова", callback_data=callback.data)
         await safe_edit_message(
             callback.message,
             "Произошла временная ошибка. Пожалуйста, попробуйте позже.",
-            reply_markup=builder.as_markup()
+            reply_markup=get_retry_keyboard(callback.data)
         )
         await state.clear()
 
-@router.callback_query(StateFilter(UserStates.waiting_for_booking_confirmation), F.data == "finish_booking")
+@cb("finish_booking", UserStates.waiting_for_booking_confirmation)
 async def process_finish_booking(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     first_name = data.get('first_name')
@@ -1246,20 +1775,19 @@ async def process_finish_booking(callback: CallbackQuery, state: FSMContext):
     await add_return_command(callback.from_user.id, book_title)
     await state.clear()
 
-@router.callback_query(F.data.startswith("return_"))
+@cb_prefix("return_")
 async def process_return_book(callback: CallbackQuery, state: FSMContext):
     book_title = callback.data.replace("return_", "")
-    user_info = await get_user_info(callback.from_user.id)
+    user_info = await get_user_context(callback.from_user.id)
     if not user_info:
         await callback.answer("Ошибка: пользователь не найден")
         return
-    booking_info = await get_user_booking(callback.from_user.id)
-    if not booking_info or booking_info['book_title'] != book_title:
+    if user_info['booking_id'] is None or user_info['book_title'] != book_title:
         await callback.answer("У вас нет активного бронирования этой книги")
         return
 
-    booking_id = booking_info['booking_id']
-    book_id = booking_info['book_id']
+    booking_id = user_info['booking_id']
+    book_id = user_info['book_id']
 
     await callback.message.edit_text("📸 Отправьте, пожалуйста, фотографию книги в библиотеки")
     await state.set_state(UserStates.waiting_for_photo)
@@ -1289,32 +1817,27 @@ async def process_return_photo(message: Message, state: FSMContext):
             book_title,
             office
         )
-        photo = message.photo[-1]
-        await bot.send_photo(
-            GROUP_CHAT_ID,
-            photo.file_id,
-            caption=f"❎️ Возврат: Пользователь {first_name} {last_name} (ID: {message.from_user.id}) вернул книгу '{book_title}'"
+        audit(
+            f"❎️ Возврат: Пользователь {first_name} {last_name} (ID: {message.from_user.id}) вернул книгу '{book_title}'",
+            photo=message.photo[-1].file_id
         )
         await message.answer(
             "Спасибо, что вернули книгу. Надеемся, что она была интересной и понравилась вам.",
             reply_markup=get_finish_return_keyboard()
         )
-        await state.update_data(book_title=book_title, office=office, first_name=first_name, last_name=last_name)
         await state.set_state(UserStates.waiting_for_return_completion)
     except Exception as e:
         logger.error(f"Ошибка завершения бронирования: {e}")
-        builder = InlineKeyboardBuilder()
-        builder.button(text="Попробовать снова", callback_data=f"return_{book_title}")
         await message.answer(
             "Произошла ошибка при обработке возврата. Пожалуйста, попробуйте ещё раз.",
-            reply_markup=builder.as_markup()
+            reply_markup=get_retry_keyboard(f"return_{book_title}")
         )
 
 @router.message(StateFilter(UserStates.waiting_for_photo))
 async def ignore_text_during_photo(message: Message):
     await message.answer("Пожалуйста, отправьте фото книги, а не текстовое сообщение.")
 
-@router.callback_query(StateFilter(UserStates.waiting_for_return_completion), F.data == "finish_return")
+@cb("finish_return", UserStates.waiting_for_return_completion)
 async def process_finish_return(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     first_name = data.get('first_name')
@@ -1327,47 +1850,31 @@ async def process_finish_return(callback: CallbackQuery, state: FSMContext):
     )
     await state.clear()
 
-@router.callback_query(F.data == "action_book")
-async def process_action_book_any_state(callback: CallbackQuery, state: FSMContext):
-    await remove_book_command(callback.from_user.id)
-    await process_start_booking(callback.message, state)
-    await callback.answer()
-
-@router.callback_query(F.data.startswith("extend_"))
+@cb_prefix("extend_")
 async def process_extend_booking(callback: CallbackQuery, state: FSMContext):
     booking_id = int(callback.data.replace("extend_", ""))
     uid = callback.from_user.id
 
-    async with db.pool.acquire() as conn:
-        booking = await conn.fetchrow(
-            '''SELECT b.*, u.first_name, u.last_name 
-               FROM bookings b
-               JOIN users u ON b.user_id = u.user_id
-               WHERE b.id = $1 AND b.user_id = $2 AND b.status = 'active' ''',
-            booking_id, uid
-        )
-        if not booking:
-            await callback.answer("❌ Бронирование не найдено или уже завершено", show_alert=True)
-            return
-        if booking['extension_made']:
-            await callback.answer("❌ Вы уже продлевали это бронирование", show_alert=True)
-            return
+    try:
+        booking, ext_text = await extend_booking(booking_id, uid)
+    except ValueError as e:
+        await callback.answer(f"❌ {e}", show_alert=True)
+        return
+    except Exception as e:
+        logger.error(f"Ошибка продления: {e}")
+        await callback.answer("❌ Не удалось продлить бронь", show_alert=True)
+        return
 
-        try:
-            new_end, ext_text = await extend_booking(booking_id, uid, booking['book_title'], booking['office'])
-            await bot.send_message(
-                GROUP_CHAT_ID,
-                f"⚠️ Продление: Пользователь {booking['first_name']} {booking['last_name']} (ID: {uid}) "
-                f"продлил бронь на {ext_text}"
-            )
-            await callback.message.edit_text(
-                f"{booking['first_name']}, вы продлили бронь книги '{booking['book_title']}' на {ext_text}.\n"
-                f"Новая дата возврата: {new_end.strftime('%d.%m.%Y %H:%M')}"
-            )
-            await callback.answer("✅ Бронь продлена")
-        except Exception as e:
-            logger.error(f"Ошибка продления: {e}")
-            await callback.answer("❌ Не удалось продлить бронь", show_alert=True)
+    audit(
+        f"⚠️ Продление: Пользователь {booking['first_name']} {booking['last_name']} (ID: {uid}) "
+        f"продлил бронь на {ext_text}"
+    )
+    await safe_edit_message(
+        callback.message,
+        f"{booking['first_name']}, вы продлили бронь книги '{booking['book_title']}' на {ext_text}.\n"
+        f"Новая дата возврата: {booking['end_time'].strftime('%d.%m.%Y %H:%M')}"
+    )
+    await callback.answer("✅ Бронь продлена")
 
 @router.message(StateFilter(UserStates.waiting_for_book_request))
 async def process_book_request(message: Message, state: FSMContext):
@@ -1392,7 +1899,7 @@ async def process_book_request(message: Message, state: FSMContext):
 
     try:
         await bot.send_message(
-            GROUP_CHAT_ID,
+            CFG.group_chat_id,
             f"🆕 Заказ: Пользователь {first_name} {last_name} (ID: {uid}) просит заказать в библиотеку:\n\n{req_text}"
         )
     except Exception as e:
@@ -1409,6 +1916,21 @@ async def process_book_request(message: Message, state: FSMContext):
     await state.clear()
 
 # ------------------------------ Админ-функции ------------------------------
+# Пакетные правки каталога и пользователей от разных админов идут по очереди:
+# одновременно они занимают не больше одного соединения пула
+admin_edit_lock = asyncio.Lock()
+
+def build_catalog_text(rows: List[asyncpg.Record]) -> str:
+    # Без parse_mode: символы разметки в названиях не ломают отправку
+    text_lines = ["📚 Полный каталог библиотеки:\n"]
+    # Строки уже отсортированы по офису — группируем за один проход
+    for office, books in groupby(rows, key=itemgetter('office')):
+        text_lines.append(f"\n🏢 {office}")
+        for b in books:
+            location = format_location(b['shelf'], b['floor']) if office == "Stone Towers" else ""
+            text_lines.append(f"  • {b['title']} — {b['author']}{location}")
+    return "\n".join(text_lines)
+
 async def send_all_books_list(target_message: Message):
     """Отправляет в группу полный каталог книг (с полками/этажами для Stone Towers)"""
     async with db.pool.acquire() as conn:
@@ -1422,49 +1944,27 @@ async def send_all_books_list(target_message: Message):
         await target_message.reply("📚 В библиотеке пока нет ни одной книги.")
         return
 
-    offices = {}
-    for r in rows:
-        off = r['office']
-        if off not in offices:
-            offices[off] = []
-        offices[off].append(r)
-
-    text_lines = ["📚 **Полный каталог библиотеки:**\n"]
-    for office, books in offices.items():
-        text_lines.append(f"\n🏢 **{office}**")
-        for b in books:
-            line = f"  • {b['title']} — {b['author']}"
-            if office == "Stone Towers" and b['shelf'] and b['floor']:
-                line += f" (полка {b['shelf']}, этаж {b['floor']})"
-            text_lines.append(line)
-
-    full_text = "\n".join(text_lines)
+    # Большой каталог собирается в потоке, чтобы не задерживать остальные обработчики
+    full_text = await asyncio.to_thread(build_catalog_text, rows)
     if len(full_text) <= 4096:
-        await target_message.reply(full_text, parse_mode="Markdown")
+        await target_message.reply(full_text)
     else:
-        part = 1
-        chunk = ""
-        for line in text_lines:
-            if len(chunk) + len(line) > 4000:
-                await target_message.reply(f"📚 Каталог (часть {part}):\n{chunk}", parse_mode="Markdown")
-                part += 1
-                chunk = line + "\n"
-            else:
-                chunk += line + "\n"
-        if chunk:
-            await target_message.reply(f"📚 Каталог (часть {part}):\n{chunk}", parse_mode="Markdown")
-
-async def start_books_edit(cmd_message: Message):
-    global group_awaiting_action, group_awaiting_author
-    group_awaiting_action = 'books'
-    group_awaiting_author = cmd_message.from_user.id
+        # Длинный каталог — одним файлом вместо серии сообщений
+        await target_message.reply_document(
+            BufferedInputFile(full_text.encode('utf-8'), filename="catalog.txt"),
+            caption="📚 Полный каталог библиотеки"
+        )
+
+async def start_books_edit(cmd_message: Message, state: FSMContext):
+    await state.set_state(AdminStates.editing_books)
     await cmd_message.reply(
         "📘 **Режим редактирования каталога**\n\n"
         "**➕ Добавление книги:**\n"
         "`+, Название, Автор, Офис, Этаж, Полка`\n"
         "• Этаж и полка — числа, **обязательны для Stone Towers**.\n"
         "• Для других офисов ставьте `-`.\n"
-        "• Дубликаты **разрешены** – можно добавить сколько угодно копий.\n\n"
+        "• Дубликаты **разрешены** – можно добавить сколько угодно копий.\n"
+        "• Название с запятой возьмите в кавычки: `\"Война, мир\"`.\n\n"
         "**➖ Удаление книги (ВСЕХ копий):**\n"
         "`-, Название, Офис`\n"
         "• Удаляются **все строки** с таким названием и офисом.\n\n"
@@ -1473,74 +1973,104 @@ async def start_books_edit(cmd_message: Message):
         "`-, Мастер и Маргарита, Stone Towers`"
     )
 
-async def process_books_edit(message: Message):
-    global group_awaiting_action, group_awaiting_author
-    lines = message.text.strip().split('\n')
+# Пробелы между закрывающей кавычкой и запятой: csv в строгом режиме их не допускает
+QUOTE_BEFORE_COMMA = re.compile(r'"\s+(?=,|$)')
+
+def parse_catalog_line(line: str) -> List[str]:
+    """Поля строки каталога: кавычки группируют поле с запятой, иначе — простое деление по запятым"""
+    if line.count('"') % 2:
+        # Непарная кавычка (Пластинка 12") — часть названия
+        parts = line.split(',')
+    else:
+        try:
+            parts = next(csv.reader([QUOTE_BEFORE_COMMA.sub('"', line)], skipinitialspace=True, strict=True))
+        except csv.Error:
+            # Кавычки внутри поля (Книга "X" и Y) — часть названия, а не экранирование
+            parts = line.split(',')
+    return [p.strip() for p in parts]
+
+async def process_books_edit(message: Message, state: FSMContext):
     results = []
-    async with db.pool.acquire() as conn:
-        for line in lines:
-            line = line.strip()
-            if not line:
+    to_insert = []
+    to_delete = []  # (позиция в отчёте, название, офис)
+    # Каждая строка разбирается отдельно: ошибка в одной не затрагивает остальные
+    for line in message.text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        parts = parse_catalog_line(line)
+        if len(parts) < 2:
+            results.append(f"❌ Пропущена строка (недостаточно данных): {line}")
+            continue
+
+        action = parts[0]
+        title = parts[1]
+
+        if action == '+':
+            if len(parts) < 6:
+                results.append(f"❌ Добавление: нужно минимум 6 полей: {line}")
+                continue
+            author = parts[2]
+            office = parts[3]
+            try:
+                floor = int(parts[4]) if parts[4] not in ('-', '') else None
+                shelf = int(parts[5]) if parts[5] not in ('-', '') else None
+            except ValueError:
+                results.append(f"❌ Этаж/полка должны быть числами или '-': {line}")
                 continue
-            parts = [p.strip() for p in line.split(',')]
-            if len(parts) < 2:
-                results.append(f"❌ Пропущена строка (недостаточно данных): {line}")
+
+            if office == "Stone Towers" and (floor is None or shelf is None):
+                results.append(f"❌ Для Stone Towers нужно указать и этаж, и полку: {line}")
                 continue
 
-            action = parts[0]
-            title = parts[1]
-
-            if action == '+':
-                if len(parts) < 6:
-                    results.append(f"❌ Добавление: нужно минимум 6 полей: {line}")
-                    continue
-                author = parts[2]
-                office = parts[3]
-                try:
-                    floor = int(parts[4]) if parts[4].strip() not in ('-', '') else None
-                    shelf = int(parts[5]) if parts[5].strip() not in ('-', '') else None
-                except ValueError:
-                    results.append(f"❌ Этаж/полка должны быть числами или '-': {line}")
-                    continue
-
-                if office == "Stone Towers" and (floor is None or shelf is None):
-                    results.append(f"❌ Для Stone Towers нужно указать и этаж, и полку: {line}")
-                    continue
-
-                await conn.execute(
-                    '''
-                    INSERT INTO books (title, author, office, shelf, floor, status)
-                    VALUES ($1, $2, $3, $4, $5, 'available')
-                    ''',
-                    title, author, office, shelf, floor
-                )
-                results.append(f"✅ Добавлена копия: '{title}' ({office})")
-
-            elif action == '-':
-                if len(parts) < 3:
-                    results.append(f"❌ Удаление: нужно указать название и офис: {line}")
-                    continue
-                office = parts[2]
-
-                deleted = await conn.execute(
-                    'DELETE FROM books WHERE LOWER(title) = LOWER($1) AND office = $2',
-                    title, office
-                )
-                deleted_count = deleted.split()[1] if hasattr(deleted, 'split') else '0'
-                results.append(f"✅ Удалено копий: {deleted_count} — '{title}' ({office})")
+            to_insert.append((title, author, office, shelf, floor))
+            results.append(f"✅ Добавлена копия: '{title}' ({office})")
 
-            else:
-                results.append(f"❌ Неизвестное действие (ожидалось + или -): {line}")
+        elif action == '-':
+            if len(parts) < 3:
+                results.append(f"❌ Удаление: нужно указать название и офис: {line}")
+                continue
+            to_delete.append((len(results), title, parts[2]))
+            results.append(None)
 
-    report = "📊 **Результат обработки каталога:**\n\n" + "\n".join(results)
-    await message.reply(report, parse_mode="Markdown")
-    group_awaiting_action = None
-    group_awaiting_author = None
+        else:
+            results.append(f"❌ Неизвестное действие (ожидалось + или -): {line}")
+
+    # Все изменения — одной транзакцией: удаление одним запросом, вставка пакетом
+    deleted = []
+    if to_insert or to_delete:
+        async with admin_edit_lock, db.pool.acquire() as conn:
+            async with conn.transaction():
+                if to_delete:
+                    deleted = await conn.fetch(
+                        '''
+                        DELETE FROM books b
+                        USING unnest($1::text[], $2::text[]) AS d(title, office)
+                        WHERE b.title_norm = LOWER(d.title) AND b.office = d.office
+                        RETURNING d.title, d.office
+                        ''',
+                        [title for _, title, _ in to_delete],
+                        [office for _, _, office in to_delete]
+                    )
+                if to_insert:
+                    await conn.executemany(
+                        '''
+                        INSERT INTO books (title, author, office, shelf, floor, status)
+                        VALUES ($1, $2, $3, $4, $5, 'available')
+                        ''',
+                        to_insert
+                    )
+
+    deleted_counts = Counter((r['title'], r['office']) for r in deleted)
+    for pos, title, office in to_delete:
+        results[pos] = f"✅ Удалено копий: {deleted_counts[(title, office)]} — '{title}' ({office})"
+
+    report = "📊 Результат обработки каталога:\n\n" + "\n".join(results)
+    await message.reply(report)
+    await state.clear()
 
-async def start_users_edit(cmd_message: Message):
-    global group_awaiting_action, group_awaiting_author
-    group_awaiting_action = 'users'
-    group_awaiting_author = cmd_message.from_user.id
+async def start_users_edit(cmd_message: Message, state: FSMContext):
+    await state.set_state(AdminStates.editing_users)
     await cmd_message.reply(
         "👥 **Режим управления пользователями**\n\n"
         "Направьте список действий в формате:\n"
@@ -1552,141 +2082,134 @@ async def start_users_edit(cmd_message: Message):
         "? 987654321, Иван, Петров"
     )
 
-async def process_users_edit(message: Message):
-    global group_awaiting_action, group_awaiting_author
-    lines = message.text.strip().split('\n')
+# Строка редактора пользователей: действие (!!! или ?) и его аргументы
+USERS_EDIT_LINE = re.compile(r'(!!!|\?)\s*(.*)')
+
+async def process_users_edit(message: Message, state: FSMContext):
     results = []
-    async with db.pool.acquire() as conn:
-        for line in lines:
-            line = line.strip()
-            if not line:
+    to_delete = []  # (позиция в отчёте, id)
+    to_update = []  # (позиция в отчёте, id, имя, фамилия)
+    for line in message.text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = USERS_EDIT_LINE.match(line)
+        action, args = match.groups() if match else (None, '')
+
+        if action == '!!!':
+            parts = args.split()
+            if len(parts) < 1:
+                results.append(f"❌ Не указан ID: {line}")
+                continue
+            try:
+                uid = int(parts[0])
+            except ValueError:
+                results.append(f"❌ Некорректный ID: {parts[0]}")
                 continue
+            to_delete.append((len(results), uid))
+            results.append(None)
 
-            if line.startswith('!!!'):
-                parts = line[3:].strip().split()
-                if len(parts) < 1:
-                    results.append(f"❌ Не указан ID: {line}")
-                    continue
-                try:
-                    uid = int(parts[0])
-                except ValueError:
-                    results.append(f"❌ Некорректный ID: {parts[0]}")
-                    continue
-
-                user = await conn.fetchval('SELECT user_id FROM users WHERE user_id = $1', uid)
-                if not user:
-                    results.append(f"❌ Пользователь {uid} не найден")
-                    continue
-
-                async with conn.transaction():
-                    await conn.execute('DELETE FROM waiting_list WHERE user_id = $1', uid)
-                    await conn.execute('DELETE FROM bookings WHERE user_id = $1', uid)
-                    await conn.execute('DELETE FROM users WHERE user_id = $1', uid)
-                results.append(f"✅ Пользователь {uid} полностью удалён")
-
-            elif line.startswith('?'):
-                parts = line[1:].strip().split(',', 2)
-                if len(parts) < 3:
-                    results.append(f"❌ Недостаточно данных: {line}")
-                    continue
-                try:
-                    uid = int(parts[0].strip())
-                except ValueError:
-                    results.append(f"❌ Некорректный ID: {parts[0]}")
-                    continue
-                first_name = parts[1].strip()
-                last_name = parts[2].strip()
-
-                user = await conn.fetchval('SELECT user_id FROM users WHERE user_id = $1', uid)
-                if not user:
-                    results.append(f"❌ Пользователь {uid} не найден")
-                    continue
-
-                await conn.execute(
-                    'UPDATE users SET first_name = $1, last_name = $2 WHERE user_id = $3',
-                    first_name, last_name, uid
-                )
-                results.append(f"✅ Пользователь {uid} обновлён: {first_name} {last_name}")
+        elif action == '?':
+            parts = [p.strip() for p in args.split(',', 2)]
+            if len(parts) < 3:
+                results.append(f"❌ Недостаточно данных: {line}")
+                continue
+            try:
+                uid = int(parts[0])
+            except ValueError:
+                results.append(f"❌ Некорректный ID: {parts[0]}")
+                continue
+            to_update.append((len(results), uid, parts[1], parts[2]))
+            results.append(None)
 
+        else:
+            results.append(f"❌ Неизвестный формат: {line}")
+
+    if to_delete or to_update:
+        uids = [uid for _, uid in to_delete] + [uid for _, uid, _, _ in to_update]
+        async with admin_edit_lock, db.pool.acquire() as conn:
+            existing = {r['user_id'] for r in await conn.fetch(HOT_SQL["existing_users"], uids)}
+            del_ids = {uid for _, uid in to_delete if uid in existing}
+            upd_rows = [(uid, first, last) for _, uid, first, last in to_update
+                        if uid in existing and uid not in del_ids]
+            # Все удаления и правки — одной транзакцией
+            async with conn.transaction():
+                if del_ids:
+                    await conn.execute('DELETE FROM waiting_list WHERE user_id = ANY($1::bigint[])', list(del_ids))
+                    await conn.execute('DELETE FROM bookings WHERE user_id = ANY($1::bigint[])', list(del_ids))
+                    await conn.execute('DELETE FROM users WHERE user_id = ANY($1::bigint[])', list(del_ids))
+                if upd_rows:
+                    await conn.executemany(
+                        'UPDATE users SET first_name = $2, last_name = $3 WHERE user_id = $1',
+                        upd_rows
+                    )
+        for uid in existing:
+            invalidate_user_cache(uid)
+        if del_ids:
+            invalidate_user_ids()
+
+        for pos, uid in to_delete:
+            results[pos] = (f"✅ Пользователь {uid} полностью удалён" if uid in existing
+                            else f"❌ Пользователь {uid} не найден")
+        for pos, uid, first, last in to_update:
+            if uid not in existing or uid in del_ids:
+                results[pos] = f"❌ Пользователь {uid} не найден"
             else:
-                results.append(f"❌ Неизвестный формат: {line}")
+                results[pos] = f"✅ Пользователь {uid} обновлён: {first} {last}"
 
-    report = "📊 **Результат обработки пользователей:**\n\n" + "\n".join(results)
-    await message.reply(report, parse_mode="Markdown")
-    group_awaiting_action = None
-    group_awaiting_author = None
+    report = "📊 Результат обработки пользователей:\n\n" + "\n".join(results)
+    await message.reply(report)
+    await state.clear()
 
 # ------------------------------ Статистика ------------------------------
+def build_statistics_text(users: List[asyncpg.Record]) -> str:
+    lines = []
+    for user in users:
+        first = user['first_name'] or ''
+        last = user['last_name'] or ''
+        full_name = f"{first} {last}".strip()
+        lines.append(
+            f"• {user['user_id']} — {full_name}\n"
+            f"  ▫️ Активных: {user['active']} | Заверш. без продл.: {user['completed_no_ext']} | "
+            f"С продл.: {user['completed_ext']} | Просрочек: {user['overdue']}\n"
+        )
+    return "📊 Статистика пользователей библиотеки:\n\n" + "".join(lines)
+
 async def send_statistics(trigger_message: Message):
     """Собирает статистику по всем пользователям и отправляет в группу"""
+    # Все счётчики по всем пользователям — одним запросом
     async with db.pool.acquire() as conn:
-        users = await conn.fetch('SELECT user_id, first_name, last_name FROM users ORDER BY user_id')
-        
-        if not users:
-            await trigger_message.reply("❌ В базе нет пользователей.")
-            return
+        users = await conn.fetch('''
+            SELECT u.user_id, u.first_name, u.last_name,
+                   COUNT(b.id) FILTER (WHERE b.status = 'active') AS active,
+                   COUNT(b.id) FILTER (WHERE b.status = 'completed' AND NOT b.extension_made) AS completed_no_ext,
+                   COUNT(b.id) FILTER (WHERE b.status = 'completed' AND b.extension_made) AS completed_ext,
+                   COUNT(b.id) FILTER (WHERE b.overdue_notified) AS overdue
+            FROM users u
+            LEFT JOIN bookings b ON b.user_id = u.user_id
+            GROUP BY u.user_id
+            ORDER BY u.user_id
+        ''')
 
-        lines = []
-        for user in users:
-            uid = user['user_id']
-            first = user['first_name'] or ''
-            last = user['last_name'] or ''
-            full_name = f"{first} {last}".strip()
-
-            active = await conn.fetchval(
-                'SELECT COUNT(*) FROM bookings WHERE user_id = $1 AND status = $2',
-                uid, 'active'
-            ) or 0
-
-            completed_no_ext = await conn.fetchval(
-                'SELECT COUNT(*) FROM bookings WHERE user_id = $1 AND status = $2 AND extension_made = $3',
-                uid, 'completed', False
-            ) or 0
-
-            completed_ext = await conn.fetchval(
-                'SELECT COUNT(*) FROM bookings WHERE user_id = $1 AND status = $2 AND extension_made = $3',
-                uid, 'completed', True
-            ) or 0
-
-            overdue = await conn.fetchval(
-                'SELECT COUNT(*) FROM bookings WHERE user_id = $1 AND overdue_notified = $2',
-                uid, True
-            ) or 0
-
-            line = (
-                f"• {uid} — {full_name}\n"
-                f"  ▫️ Активных: {active} | Заверш. без продл.: {completed_no_ext} | "
-                f"С продл.: {completed_ext} | Просрочек: {overdue}\n"
-            )
-            lines.append(line)
+    if not users:
+        await trigger_message.reply("❌ В базе нет пользователей.")
+        return
+
+    full_text = await asyncio.to_thread(build_statistics_text, users)
 
-    full_text = "📊 Статистика пользователей библиотеки:\n\n" + "".join(lines)
-    
     if len(full_text) <= 4096:
         await trigger_message.reply(full_text)   # 👈 убрали parse_mode
     else:
-        parts = []
-        current_part = "📊 Статистика (часть 1):\n\n"
-        part_num = 1
-        for line in lines:
-            if len(current_part) + len(line) > 4000:
-                parts.append(current_part)
-                part_num += 1
-                current_part = f"📊 Статистика (часть {part_num}):\n\n"
-            current_part += line
-        parts.append(current_part)
-
-        for part in parts:
-            await trigger_message.reply(part)    # 👈 и здесь тоже
-            await asyncio.sleep(0.3)
+        await trigger_message.reply_document(
+            BufferedInputFile(full_text.encode('utf-8'), filename="statistics.txt"),
+            caption="📊 Статистика пользователей библиотеки"
+        )
 
 # ------------------------------ Единый обработчик группы ------------------------------
-@router.message(F.chat.id == GROUP_CHAT_ID, F.text, ~F.from_user.is_bot)
-async def group_text_handler(message: Message):
+@router.message(F.chat.id == CFG.group_chat_id, F.text, ~F.from_user.is_bot)
+async def group_text_handler(message: Message, state: FSMContext):
     """Единый обработчик всех текстовых сообщений в группе"""
-    global group_awaiting_action, group_awaiting_author
     text = message.text.strip()
-    user_id = message.from_user.id
 
     # ---------- АДМИН-КОМАНДЫ ----------
     if text.lower() == "книги":
@@ -1694,19 +2217,20 @@ async def group_text_handler(message: Message):
         return
 
     if text == "!книги!":
-        await start_books_edit(message)
+        await start_books_edit(message, state)
         return
 
     if text == "!пользователи!":
-        await start_users_edit(message)
+        await start_users_edit(message, state)
         return
 
     # ---------- ОЖИДАНИЕ ВВОДА СПИСКОВ ----------
-    if group_awaiting_action and user_id == group_awaiting_author:
-        if group_awaiting_action == 'books':
-            await process_books_edit(message)
-        elif group_awaiting_action == 'users':
-            await process_users_edit(message)
+    current_state = await state.get_state()
+    if current_state == AdminStates.editing_books.state:
+        await process_books_edit(message, state)
+        return
+    if current_state == AdminStates.editing_users.state:
+        await process_users_edit(message, state)
         return
 
     # ---------- СТАТИСТИКА ----------
@@ -1715,24 +2239,30 @@ async def group_text_handler(message: Message):
         return
 
     # ---------- МАССОВАЯ РАССЫЛКА ----------
-    async with db.pool.acquire() as conn:
-        user_ids = await conn.fetch('SELECT user_id FROM users')
+    if message.from_user.id not in CFG.admin_ids:
+        return
+
+    user_ids = await get_all_user_ids()
     if not user_ids:
         logger.info("Нет пользователей для рассылки")
         return
 
-    broadcast_text = f"📢 Сообщение от администрации:\n\n{message.text}"
-    sent = 0
-    failed = 0
-    for rec in user_ids:
-        uid = rec['user_id']
+    # Текст рассылки публикуется в группе один раз, пользователям уходит его копия
+    source = await message.reply(f"📢 Сообщение от администрации:\n\n{message.text}")
+
+    async def send_one(uid: int) -> bool:
+        bulk_send.set(True)
         try:
-            await bot.send_message(uid, broadcast_text)
-            sent += 1
-            await asyncio.sleep(0.05)
+            await bot.copy_message(chat_id=uid, from_chat_id=source.chat.id, message_id=source.message_id)
+            return True
         except Exception as e:
             logger.error(f"Не удалось отправить пользователю {uid}: {e}")
-            failed += 1
+            return False
+
+    # Отправки идут параллельно (каждая в своей задаче), темп держит _bulk_limiter
+    results = await asyncio.gather(*(send_one(uid) for uid in user_ids))
+    sent = sum(results)
+    failed = len(results) - sent
     logger.info(f"Рассылка завершена. Отправлено: {sent}, ошибок: {failed}")
     await message.reply(f"✅ Сообщение разослано {sent} пользователям. Ошибок: {failed}")
 
@@ -1750,11 +2280,15 @@ async def wait_for_db():
 async def main():
     try:
         logger.info("Запуск библиотечного бота...")
+        if not CFG.admin_ids:
+            logger.warning("ADMIN_IDS не задан — массовая рассылка отключена")
         if not await wait_for_db():
             logger.error("Не удалось подключиться к БД")
             return
         await init_db()
+        await restore_reminders()
         asyncio.create_task(check_reminders())
+        asyncio.create_task(audit_worker())
         logger.info("Бот готов к работе!")
         await dp.start_polling(bot)
     except Exception as e: